@@ -0,0 +1,18 @@
+import argparse
+import sys
+
+# Shared by the benchmarks, which are run from the bot directory with
+# `python -m benchmarks.<name>` and exit with status 1 if any check failed
+
+
+def make_parser(description: str):
+    return argparse.ArgumentParser(description=description)
+
+
+def finish(failures: list, shown: int = 20):
+    """Print the first `shown` failures and exit"""
+    for failure in failures[:shown]:
+        print(f"FAIL: {failure}")
+    if len(failures) > shown:
+        print(f"...and {len(failures) - shown} more")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,206 @@
+import asyncio
+import random
+import sys
+from collections import namedtuple
+from time import perf_counter
+from types import SimpleNamespace
+
+from benchmarks.common import finish, make_parser
+from cogs.fun.counting import Counting
+
+# Run from the bot directory with `python -m benchmarks.counting`
+#
+# Members in several guilds send counting messages concurrently, while the
+# last counted message keeps getting deleted. Messages are counted in the
+# order they were submitted, so replaying that order through the counting
+# rules gives the state every guild should end up in. A troll warning may
+# only take the place of the message that was deleted, never a newer count.
+
+Settings = namedtuple("Settings", ("enabled", "channel_id", "allow_math"))
+
+
+class FakeDatabase():
+    """Just enough of Database for the counting engine, counting its writes"""
+
+    def __init__(self):
+        self.writes = 0
+
+    def register(self, statements: dict):
+        pass
+
+    async def fetchone(self, statement: str, parameters: tuple = None):
+        return None
+
+    async def fetchall(self, statement: str, parameters: tuple = None):
+        return None
+
+    async def execute(self, statement: str, parameters: tuple = None):
+        self.writes += 1
+
+
+class FakeSettings():
+    async def get(self, table: str, guild_id: int):
+        return Settings(True, guild_id, False)
+
+    def peek(self, table: str, guild_id: int):
+        return Settings(True, guild_id, False)
+
+    def subscribe(self, table: str, callback):
+        pass
+
+    def watching(self, table: str, channel_id: int):
+        return True
+
+
+async def react(*args, **kwargs):
+    pass
+
+
+def make_message(guild_id: int, member_id: int, message_id: int, content: str):
+    return SimpleNamespace(
+        id=message_id,
+        guild=SimpleNamespace(id=guild_id),
+        channel=SimpleNamespace(id=guild_id, send=react),
+        author=SimpleNamespace(id=member_id, mention=f"<@{member_id}>"),
+        clean_content=content,
+        add_reaction=react
+    )
+
+
+def replay(messages: list):
+    """(next_number, highscore, last_message_id) after counting messages one at a time"""
+    nextNumber, highscore, lastMember, lastMessage = 1, 0, None, None
+    for member_id, number, message_id in messages:
+        if number != nextNumber and nextNumber == 1:
+            continue
+        if number != nextNumber or member_id == lastMember:
+            highscore = max(nextNumber - 1, highscore)
+            nextNumber, lastMember, lastMessage = 1, None, None
+        else:
+            nextNumber += 1
+            lastMember, lastMessage = member_id, message_id
+    return nextNumber, highscore, lastMessage
+
+
+async def main():
+    parser = make_parser(
+        "Stress test the counting engine with concurrent counters")
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--members", type=int, default=10,
+                        help="concurrent members counting in each guild")
+    parser.add_argument("--messages", type=int, default=1000,
+                        help="messages each member sends")
+    args = parser.parse_args()
+
+    messageIDs = iter(range(1, sys.maxsize))
+    sent = set()
+    # warning message ID -> the deleted message it stands in for
+    warnings = {}
+
+    async def fetch_user(member_id: int):
+        await asyncio.sleep(0)
+        return SimpleNamespace(mention=f"<@{member_id}>")
+
+    def get_channel(channel_id: int):
+        async def send(content: str):
+            await asyncio.sleep(0)
+            sent.add(messageID := next(messageIDs))
+            return SimpleNamespace(id=messageID)
+        return SimpleNamespace(id=channel_id, send=send)
+
+    database = FakeDatabase()
+    bot = SimpleNamespace(
+        database=database,
+        settings=FakeSettings(),
+        loop=asyncio.get_running_loop(),
+        wait_until_ready=react,
+        get_or_fetch_user=fetch_user,
+        get_channel=get_channel
+    )
+    cog = Counting(bot)
+
+    handled = 0
+    count = cog.engine.handler
+
+    async def handler(message):
+        nonlocal handled
+        try:
+            await count(message)
+        finally:
+            handled += 1
+    cog.engine.handler = handler
+
+    random.seed(0)
+    submitted = {guild_id: [] for guild_id in range(1, args.guilds + 1)}
+    counting = 0
+
+    async def member(guild_id: int, member_id: int):
+        nonlocal counting
+        for _ in range(args.messages):
+            # Members race each other for the next number, and sometimes get it wrong
+            state = cog.engine.states.get(guild_id)
+            number = state.next_number if state else 1
+            if random.random() < 0.01:
+                number += 1
+
+            messageID = next(messageIDs)
+            submitted[guild_id].append((member_id, number, messageID))
+            cog.engine.submit(guild_id, make_message(
+                guild_id, member_id, messageID, str(number)))
+
+            # Think for a moment, leaving gaps for a troll warning to be sent
+            for _ in range(random.randrange(2 * args.members)):
+                await asyncio.sleep(0)
+        counting -= 1
+
+    async def troll(guild_id: int):
+        while counting:
+            await asyncio.sleep(0)
+            state = cog.engine.states.get(guild_id)
+            if not state or state.last_message_id is None:
+                continue
+
+            deleted = state.last_message_id
+            payload = SimpleNamespace(
+                guild_id=guild_id, channel_id=guild_id, message_id=deleted)
+            await cog.prevent_trolling(payload)
+            if state.last_message_id in sent:
+                warnings.setdefault(state.last_message_id, deleted)
+
+    start = perf_counter()
+    counting = args.guilds * args.members
+    await asyncio.gather(
+        *(member(guild_id, member_id)
+          for guild_id in submitted for member_id in range(args.members)),
+        *(troll(guild_id) for guild_id in submitted))
+    total = sum(len(messages) for messages in submitted.values())
+    while handled < total:
+        await asyncio.sleep(0)
+    elapsed = perf_counter() - start
+    await cog.engine.flush()
+
+    failures = []
+    for guild_id, messages in submitted.items():
+        state = cog.engine.states[guild_id]
+        nextNumber, highscore, lastMessage = replay(messages)
+        if (state.next_number, state.highscore) != (nextNumber, highscore):
+            failures.append(
+                f"guild {guild_id} ended at {(state.next_number, state.highscore)}, expected {(nextNumber, highscore)}")
+
+        # Follow warnings back to the message they stand in for
+        messageID = state.last_message_id
+        while messageID in warnings:
+            messageID = warnings[messageID]
+        if messageID != lastMessage:
+            failures.append(
+                f"guild {guild_id} lost track of its last counted message {lastMessage}")
+
+    print(
+        f"{total} messages and {len(warnings)} troll warnings in {elapsed:.2f}s ({total / elapsed:,.0f}/s), {database.writes} database writes")
+
+    cog.cog_unload()
+    finish(failures)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+import random
+from fractions import Fraction
+from time import perf_counter
+
+from benchmarks.common import finish, make_parser
+from cogs.fun.counting import MAX_LENGTH, do_math, evaluate
+
+# Run from the bot directory with `python -m benchmarks.counting_math`
+#
+# Times math mode on the most expensive messages we know of, plus random
+# ones, with the cache cleared so every message is evaluated from scratch.
+
+MAX_LATENCY = 0.001
+
+CHECKS = {
+    "1+1": 2,
+    "0.1+0.2": Fraction(3, 10),
+    "2(3+4)": 14,
+    "2^10": 1024,
+    "3x3": 9,
+    "10/4": Fraction(5, 2),
+    "4/0": None,
+    "2^0.5": None,
+    "2^100": None,
+    "9^9^9": None,
+    "hello": None,
+    "1" * 1000: int("1" * 1000)
+}
+
+WORST_CASES = [
+    "9^9x" * 19 + "9^9",
+    "(9^9)^9",
+    "(" * 24 + "9" + ")" * 24,
+    "9^10x" * 16 + "9",
+    "99999999999999999999999^10",
+    "-" * 98 + "9",
+    "1/" * 49 + "1",
+    "0.1+" * 24 + "0.1",
+    "0.123456789/" * 8 + "0.1",
+    "1.5^10/" * 10 + "1",
+    "2(" * 24 + "2" + ")" * 24,
+    "(1+2)(3+4)" * 10,
+    "9" * 50 + "^10",
+    "9" * 99 + "x",
+    "1.23456x7.89101/" * 6 + "1",
+    "0.99999-0.12345/" * 6 + "1",
+    "(0.3/0.7+0.9/1.1)x" * 5 + "1"
+]
+
+ALPHABET = "0123456789()x^-+./ "
+
+
+def random_expression(rng: random.Random, length: int):
+    """A random, mostly well-formed expression of about `length` characters"""
+    parts = []
+    while sum(map(len, parts)) < length:
+        number = str(rng.randrange(1, 10 ** rng.randint(1, 6)))
+        if rng.random() < 0.2:
+            number += "." + str(rng.randrange(1000))
+        parts.append(number)
+        parts.append(rng.choice(["+", "-", "x", "/", "^", "("]))
+    return "".join(parts)[:length].rstrip("+-x/^(")
+
+
+def measure(expression: str, repeat: int):
+    """Median of `repeat` uncached do_math calls, in seconds"""
+    timings = []
+    for _ in range(repeat):
+        evaluate.cache_clear()
+        start = perf_counter()
+        do_math(expression)
+        timings.append(perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = make_parser(
+        "Check the worst case latency of counting's math mode")
+    parser.add_argument("--fuzz", type=int, default=20000,
+                        help="random messages to try")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="times to run each message, keeping the median")
+    args = parser.parse_args()
+
+    failures = []
+    for expression, expected in CHECKS.items():
+        if do_math(expression) != expected:
+            failures.append(f"{expression[:20]!r} gave {do_math(expression)!r}")
+
+    rng = random.Random(0)
+    fuzz = [
+        "".join(rng.choice(ALPHABET) for _ in range(rng.randint(1, MAX_LENGTH)))
+        for _ in range(args.fuzz // 2)
+    ] + [random_expression(rng, rng.randint(1, MAX_LENGTH)) for _ in range(args.fuzz // 2)]
+
+    for name, expressions in (("worst cases", WORST_CASES), ("fuzz", fuzz)):
+        timings = sorted((measure(e, args.repeat), e) for e in expressions)
+        median = timings[len(timings) // 2][0]
+        slowest, expression = timings[-1]
+        print(
+            f"{name}: median {median * 1e6:.0f} µs, slowest {slowest * 1e6:.0f} µs ({expression!r})")
+
+        failures += [
+            f"{e!r} took {t * 1e6:.0f} µs" for t, e in timings if t > MAX_LATENCY]
+
+    finish(failures)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import random
+from time import process_time
+from types import SimpleNamespace
+
+from benchmarks.common import finish, make_parser
+from cogs.fun.music import Music
+
+# Run from the bot directory with `python -m benchmarks.gateway_frames`
+#
+# Replays synthetic raw gateway frames through the music cog's
+# on_socket_raw_receive, and through the old listener that parsed every
+# frame, and compares CPU time and which voice updates reached Lavalink.
+
+BOT_ID = 1
+
+WORDS = ["voice", "music", "play", "skip", "lol", "the", "queue",
+         "server", "again", "what", "song", "is", "this", "nice"]
+
+
+async def on_socket_raw_receive(self, msg):
+    """The old listener, parsing every frame"""
+    data = json.loads(msg)
+
+    if not data or "t" not in data:
+        return
+
+    if data["t"] == "VOICE_SERVER_UPDATE":
+        guild_id = int(data["d"]["guild_id"])
+        player = self.bot.lavalink.player_manager.get(guild_id)
+
+        if player:
+            await player._voice_server_update(data["d"])
+
+    elif data["t"] == "VOICE_STATE_UPDATE":
+        if int(data["d"]["user_id"]) != int(self.bot.user.id):
+            return
+
+        guild_id = int(data["d"]["guild_id"])
+        player = self.bot.lavalink.player_manager.get(guild_id)
+
+        if player:
+            await player._voice_state_update(data["d"])
+
+
+class Player():
+    """Records the voice updates that would be forwarded to Lavalink"""
+
+    def __init__(self, guild_id: int, received: list):
+        self.guild_id = guild_id
+        self.received = received
+
+    async def _voice_server_update(self, data: dict):
+        self.received.append(("server", self.guild_id, data["endpoint"]))
+
+    async def _voice_state_update(self, data: dict):
+        self.received.append(("state", self.guild_id, data["session_id"]))
+
+
+def make_frame(rng: random.Random, sequence: int):
+    """A compact raw gateway frame, as Discord sends them"""
+    guild_id = str(rng.randrange(10 ** 17, 10 ** 18))
+    user_id = str(rng.choice([BOT_ID, rng.randrange(10 ** 17, 10 ** 18)]))
+    kind = rng.random()
+
+    if kind < 0.45:
+        event = "MESSAGE_CREATE"
+        content = " ".join(rng.choices(WORDS, k=rng.randint(1, 30)))
+        # Some messages talk about voice events, and get through the filter to be parsed
+        if rng.random() < 0.01:
+            content += " VOICE_STATE_UPDATE"
+        data = {"id": str(sequence), "guild_id": guild_id, "channel_id": guild_id,
+                "author": {"id": user_id, "username": "someone", "bot": False},
+                "content": content,
+                "embeds": [], "attachments": [], "mentions": []}
+    elif kind < 0.80:
+        event = "PRESENCE_UPDATE"
+        data = {"user": {"id": user_id}, "guild_id": guild_id, "status": "online",
+                "activities": [{"name": "a game", "type": 0}], "client_status": {"desktop": "online"}}
+    elif kind < 0.95:
+        event = "TYPING_START"
+        data = {"user_id": user_id, "guild_id": guild_id,
+                "channel_id": guild_id, "timestamp": 1660000000}
+    elif kind < 0.998:
+        event = "MESSAGE_REACTION_ADD"
+        data = {"user_id": user_id, "guild_id": guild_id, "channel_id": guild_id,
+                "message_id": str(sequence), "emoji": {"name": "⭐", "id": None}}
+    elif kind < 0.999:
+        event = "VOICE_STATE_UPDATE"
+        data = {"user_id": user_id, "guild_id": guild_id,
+                "channel_id": guild_id, "session_id": str(sequence)}
+    else:
+        event = "VOICE_SERVER_UPDATE"
+        data = {"guild_id": guild_id, "token": str(sequence),
+                "endpoint": f"voice-{sequence}.discord.media"}
+
+    return json.dumps({"t": event, "s": sequence, "op": 0, "d": data}, separators=(",", ":"), ensure_ascii=False)
+
+
+async def replay(listener, frames: list):
+    """(CPU seconds, voice updates forwarded) for a listener over the frames"""
+    received = []
+    cog = SimpleNamespace(bot=SimpleNamespace(
+        user=SimpleNamespace(id=BOT_ID),
+        lavalink=SimpleNamespace(player_manager=SimpleNamespace(
+            get=lambda guild_id: Player(guild_id, received)))
+    ))
+
+    start = process_time()
+    for frame in frames:
+        await listener(cog, frame)
+    return process_time() - start, received
+
+
+async def main():
+    parser = make_parser(
+        "Compare the music cog's raw gateway listener with the old one")
+    parser.add_argument("--frames", type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    frames = [make_frame(rng, sequence) for sequence in range(args.frames)]
+
+    before, expected = await replay(on_socket_raw_receive, frames)
+    after, received = await replay(Music.on_socket_raw_receive, frames)
+
+    perFrames = 100000 / len(frames)
+    print(f"{len(frames)} frames, {len(expected)} voice updates forwarded")
+    print(f"parse every frame: {before * perFrames * 1000:.0f} ms CPU per 100k frames")
+    print(
+        f"filter first: {after * perFrames * 1000:.0f} ms CPU per 100k frames ({before / after:.1f}x)")
+
+    failures = []
+    if received != expected:
+        failures.append(
+            f"{len(received)} voice updates were forwarded instead of {len(expected)}")
+
+    finish(failures)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
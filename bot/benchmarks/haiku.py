@@ -0,0 +1,139 @@
+import json
+import os
+from time import perf_counter
+
+from benchmarks.common import finish, make_parser
+from cogs.fun.haiku import count_syllables, delete_markdown, find_haiku
+
+# Run from the bot directory with `python -m benchmarks.haiku`
+
+CORPUS = os.path.join(os.path.dirname(__file__), "haiku_corpus.txt")
+BASELINE = os.path.join(os.path.dirname(__file__), "haiku_baseline.json")
+
+# Detection must stay at least this accurate on the corpus
+MIN_PRECISION = 1.0
+MIN_RECALL = 0.85
+# How much slower than the saved baseline a run can be before it fails
+MAX_SLOWDOWN = 1.25
+
+# How delete_markdown reads runs of delimiters
+MARKDOWN = {
+    "**bold** and *italics*": "bold and italics",
+    "*mat ***the the** we** all on": "mat the the we all on",
+    "***both***": "both",
+    "___both___": "both",
+    "__under__ _it_": "under it",
+    "**not closed": "**not closed",
+    "||spoiler|| `code` ```block```": "spoiler code block"
+}
+
+
+def load_corpus(path: str = CORPUS):
+    """(is a haiku, message) for every labeled message in the corpus"""
+    corpus = []
+    with open(path, encoding="utf-8") as lines:
+        for line in lines:
+            if not line.strip() or line.startswith("#"):
+                continue
+            label, message = line.rstrip("\n").split("\t", 1)
+            corpus.append((label == "1", message.replace("\\n", "\n")))
+    return corpus
+
+
+def time_each(function, inputs: list, rounds: int):
+    """Per-call latencies of a function over the inputs, in seconds"""
+    latencies = []
+    for _ in range(rounds):
+        for value in inputs:
+            start = perf_counter()
+            function(value)
+            latencies.append(perf_counter() - start)
+    latencies.sort()
+    return latencies
+
+
+def summarize(latencies: list):
+    return {
+        "per_second": len(latencies) / sum(latencies),
+        "p50_us": latencies[len(latencies) // 2] * 1e6,
+        "p99_us": latencies[int(len(latencies) * 0.99)] * 1e6
+    }
+
+
+def run(rounds: int):
+    corpus = load_corpus()
+    messages = [message for _, message in corpus]
+    words = [word for message in messages for word in message.split()]
+
+    truePositives = falsePositives = falseNegatives = 0
+    for isHaiku, message in corpus:
+        found = find_haiku(message) is not None
+        truePositives += found and isHaiku
+        falsePositives += found and not isHaiku
+        falseNegatives += isHaiku and not found
+
+    found = truePositives + falsePositives
+    return {
+        "precision": truePositives / found if found else 1.0,
+        "recall": truePositives / (truePositives + falseNegatives),
+        "find_haiku": summarize(time_each(find_haiku, messages, rounds)),
+        "delete_markdown": summarize(time_each(delete_markdown, messages, rounds)),
+        "count_syllables": summarize(time_each(count_syllables, words, rounds))
+    }
+
+
+def check(results: dict, baseline: dict = None):
+    """Every way the results fall short of the accuracy floors or the baseline"""
+    failures = [
+        f"delete_markdown({text!r}) is {delete_markdown(text)!r}, not {expected!r}"
+        for text, expected in MARKDOWN.items() if delete_markdown(text) != expected]
+    if results["precision"] < MIN_PRECISION:
+        failures.append(
+            f"precision {results['precision']:.3f} is below {MIN_PRECISION}")
+    if results["recall"] < MIN_RECALL:
+        failures.append(
+            f"recall {results['recall']:.3f} is below {MIN_RECALL}")
+
+    if baseline:
+        for name in ("find_haiku", "delete_markdown", "count_syllables"):
+            slowdown = baseline[name]["per_second"] / results[name]["per_second"]
+            if slowdown > MAX_SLOWDOWN:
+                failures.append(
+                    f"{name} is {slowdown:.2f}x slower than the baseline")
+    return failures
+
+
+def main():
+    parser = make_parser(
+        "Benchmark the Haiku module's detection speed and accuracy")
+    parser.add_argument("--rounds", type=int, default=200,
+                        help="times to run through the corpus")
+    parser.add_argument("--save", action="store_true",
+                        help="save this run as the baseline to compare later runs to")
+    args = parser.parse_args()
+
+    results = run(args.rounds)
+
+    print(
+        f"precision {results['precision']:.3f}, recall {results['recall']:.3f}")
+    for name in ("find_haiku", "delete_markdown", "count_syllables"):
+        stats = results[name]
+        print(
+            f"{name}: {stats['per_second']:,.0f}/s, p50 {stats['p50_us']:.1f} µs, p99 {stats['p99_us']:.1f} µs")
+
+    baseline = None
+    if args.save:
+        with open(BASELINE, "w") as file:
+            json.dump(results, file, indent=4)
+    elif os.path.exists(BASELINE):
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+    else:
+        print("No saved baseline, so speed wasn't checked (save one with --save)")
+
+    failures = check(results, baseline)
+    finish(failures)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from timeit import timeit
+
+import numpy as np
+
+from benchmarks.common import finish, make_parser
+from cogs.fun.leveling import MAX_LEVEL, get_level, get_levels, get_xp
+
+# Run from the bot directory with `python -m benchmarks.levels`
+
+LEVELS = (0, 10, 100, 250, 500, 750, 1000, 1200)
+
+
+def get_level_loop(xp: int):
+    """The old lookup, walking up from level 0"""
+    level = 0
+    while get_xp(level) <= xp:
+        level += 1
+    return level - 1
+
+
+def main():
+    parser = make_parser(
+        "Benchmark level lookups against the old loop")
+    parser.add_argument("--members", type=int, default=1000000,
+                        help="members to recompute in the batch benchmark")
+    args = parser.parse_args()
+
+    failures = []
+    for level in LEVELS:
+        # Halfway to the next level
+        xp = (get_xp(level) + get_xp(level + 1)) // 2
+        if get_level(xp) != get_level_loop(xp) or get_level(xp) != level:
+            failures.append(f"get_level({xp}) is wrong")
+
+        number = 2000
+        loop = timeit(lambda: get_level_loop(xp), number=number) / number
+        table = timeit(lambda: get_level(xp), number=number) / number
+        print(
+            f"level {level}: loop {loop * 1e6:.2f} µs, table {table * 1e6:.2f} µs ({loop / table:.0f}x)")
+
+    xps = np.random.default_rng(0).integers(
+        0, get_xp(MAX_LEVEL), args.members, dtype=np.int64)
+    sampled = xps[:10000].tolist()
+    if get_levels(xps[:10000]).tolist() != [get_level(xp) for xp in sampled]:
+        failures.append("get_levels disagrees with get_level")
+
+    single = timeit(lambda: [get_level(xp) for xp in sampled], number=1) / len(sampled)
+    batch = timeit(lambda: get_levels(xps), number=1) / len(xps)
+    print(
+        f"{args.members} members: get_level {single * 1e9:.0f} ns, get_levels {batch * 1e9:.0f} ns per member")
+
+    finish(failures)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+from random import randint, sample
+from time import perf_counter
+
+import psycopg
+
+from benchmarks.common import make_parser
+from tools.database import Database
+
+# Run from the bot directory with `python -m benchmarks.round_trips`, using the
+# same POSTGRES_* environment variables as the bot. Votes go to a scratch
+# table that is dropped afterwards.
+
+TABLE = "BenchmarkPollVotes"
+
+
+async def vote_separately(database: Database, message_id: int, member_id: int, options: list):
+    """A Polls vote the way it used to run, one commit per statement"""
+    await database.execute(f"""
+    DELETE FROM {TABLE}
+    WHERE message_id = %s AND member_id = %s;
+    """, (message_id, member_id))
+
+    for option in options:
+        await database.execute(f"""
+        INSERT INTO {TABLE}
+        VALUES (%s, %s, %s);
+        """, (message_id, member_id, option))
+
+    voteCounts = await database.fetchall(f"""
+    SELECT option, COUNT(*) FROM {TABLE}
+    WHERE message_id = %s
+    GROUP BY option
+    ORDER BY option ASC;
+    """, (message_id,))
+
+    totalVotes = await database.fetchone(f"""
+    SELECT COUNT(*) FROM {TABLE}
+    WHERE message_id = %s;
+    """, (message_id,))
+
+    return voteCounts, totalVotes[0]
+
+
+async def vote_in_transaction(database: Database, message_id: int, member_id: int, options: list):
+    """A Polls vote the way it runs now, see Polls.on_interaction"""
+    async with database.transaction() as tx:
+        await tx.execute(f"""
+        DELETE FROM {TABLE}
+        WHERE message_id = %s AND member_id = %s;
+        """, (message_id, member_id))
+
+        await tx.executemany(f"""
+        INSERT INTO {TABLE}
+        VALUES (%s, %s, %s);
+        """, [(message_id, member_id, option) for option in options])
+
+        voteCounts = await tx.execute(f"""
+        SELECT option, COUNT(*) FROM {TABLE}
+        WHERE message_id = %s
+        GROUP BY option
+        ORDER BY option ASC;
+        """, (message_id,))
+
+        totalVotes = await tx.execute(f"""
+        SELECT COUNT(*) FROM {TABLE}
+        WHERE message_id = %s;
+        """, (message_id,))
+
+    return voteCounts.fetchall(), totalVotes.fetchone()[0]
+
+
+async def measure(database: Database, vote, votes: int):
+    """(round trips per vote, milliseconds per vote)"""
+    roundTrips = database.round_trips
+    start = perf_counter()
+    for _ in range(votes):
+        await vote(database, 1, randint(1, 1000), sample(range(1, 6), randint(1, 3)))
+    elapsed = perf_counter() - start
+    return (database.round_trips - roundTrips) / votes, elapsed / votes * 1000
+
+
+async def main():
+    parser = make_parser(
+        "Compare round trips per Polls vote with and without Database.transaction()")
+    parser.add_argument("--votes", type=int, default=500)
+    args = parser.parse_args()
+
+    database = Database(min_size=1, max_size=1)
+    await database.connect()
+    try:
+        await database.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE} (
+            message_id BIGINT NOT NULL,
+            member_id BIGINT NOT NULL,
+            option SMALLINT NOT NULL
+        );
+        """)
+
+        print(f"pipeline mode: {psycopg.Pipeline.is_supported()} (libpq {psycopg.pq.version()})")
+        for name, vote in (("separate statements", vote_separately), ("transaction()", vote_in_transaction)):
+            roundTrips, milliseconds = await measure(database, vote, args.votes)
+            print(
+                f"{name}: {roundTrips:.1f} round trips, {milliseconds:.2f} ms per vote")
+    finally:
+        await database.execute(f"DROP TABLE IF EXISTS {TABLE};")
+        await database.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
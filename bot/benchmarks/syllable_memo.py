@@ -0,0 +1,92 @@
+import random
+import re
+from itertools import accumulate
+from time import perf_counter
+
+import cogs.fun.haiku as haiku
+from benchmarks.common import finish, make_parser
+from benchmarks.haiku import load_corpus
+
+# Run from the bot directory with `python -m benchmarks.syllable_memo`
+#
+# Counts the syllables of every word in a stream of chat messages, first with
+# the memoized lookups unwrapped and then with them cached. Half the messages
+# are from the haiku corpus, the rest are words drawn from the dictionary (and
+# some numbers) with a Zipf distribution, like a chat's vocabulary.
+
+
+def vocabulary(size: int, seed: int):
+    """`size` dictionary words and numbers, most common first"""
+    index = haiku.syllableDictionary
+    rng = random.Random(seed)
+    words = [
+        bytes(index.map[index.words + index.offsets[i]:index.words + index.offsets[i + 1]]).decode()
+        for i in rng.sample(range(len(index)), size)
+    ]
+    words += [str(number) for number in rng.sample(range(10000), size // 20)]
+    rng.shuffle(words)
+    return words
+
+
+def chat_words(messages: int, seed: int = 0):
+    """Words from `messages` random chat messages, as find_haiku would split them"""
+    corpus = [message for _, message in load_corpus()]
+    words = vocabulary(50000, seed)
+    weights = list(accumulate(1 / rank ** 1.1 for rank in range(1, len(words) + 1)))
+
+    rng = random.Random(seed)
+    stream = []
+    for _ in range(messages):
+        if rng.random() < 0.5:
+            message = rng.choice(corpus).replace("\n", " ")
+        else:
+            message = " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(3, 17)))
+        message = re.sub(r"([0-9]){1}\.([0-9]){1}", r"\1 point \2", message)
+        message = re.sub(r"[^\s\w-]", "", message)
+        stream += message.split()
+    return stream
+
+
+def count_all(words: list):
+    start = perf_counter()
+    counts = [haiku.count_syllables(word) for word in words]
+    return counts, perf_counter() - start
+
+
+def main():
+    parser = make_parser(
+        "Compare haiku syllable counting with and without the memoized lookups")
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    words = chat_words(args.messages)
+
+    cached = haiku.word_syllables, haiku.number_words
+    haiku.word_syllables = haiku.word_syllables.__wrapped__
+    haiku.number_words = haiku.number_words.__wrapped__
+    try:
+        uncachedCounts, uncached = count_all(words)
+    finally:
+        haiku.word_syllables, haiku.number_words = cached
+
+    for cache in cached:
+        cache.cache_clear()
+    cachedCounts, elapsed = count_all(words)
+
+    print(f"{len(words)} words from {args.messages} messages")
+    print(f"uncached: {uncached / len(words) * 1e6:.2f} µs per word")
+    print(
+        f"memoized: {elapsed / len(words) * 1e6:.2f} µs per word ({uncached / elapsed:.1f}x)")
+    for name, stats in haiku.syllable_stats().items():
+        print(
+            f"{name}: {stats['size']} cached, {stats['hit_rate']:.1%} hit rate")
+
+    failures = []
+    if cachedCounts != uncachedCounts:
+        failures.append("memoized counts differ from uncached counts")
+
+    finish(failures)
+
+
+if __name__ == "__main__":
+    main()
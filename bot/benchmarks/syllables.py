@@ -0,0 +1,82 @@
+import json
+import subprocess
+import sys
+
+from benchmarks.common import finish, make_parser
+from tools.syllables import SyllableIndex
+
+# Run from the bot directory with `python -m benchmarks.syllables`
+#
+# Each way of loading the dictionary is timed in a fresh interpreter, which
+# also reports its peak RSS, so imports and allocations aren't shared.
+
+LOADERS = {
+    "interpreter": "",
+    "cmudict.dict()": """
+import cmudict
+dictionary = cmudict.dict()
+""",
+    "SyllableIndex": """
+from tools.syllables import SyllableIndex
+dictionary = SyllableIndex(INDEX)
+dictionary.get("haiku")
+"""
+}
+
+CHILD = """
+import json, resource, sys
+from time import perf_counter
+INDEX = sys.argv[1]
+start = perf_counter()
+{loader}
+elapsed = perf_counter() - start
+# Kilobytes on Linux
+print(json.dumps([elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]))
+"""
+
+
+def load(loader: str, index: str):
+    """(seconds, peak RSS in MB) of a fresh interpreter running `loader`"""
+    output = subprocess.run([sys.executable, "-c", CHILD.format(loader=loader), index],
+                            capture_output=True, check=True, text=True).stdout
+    elapsed, rss = json.loads(output)
+    return elapsed, rss / 1024
+
+
+def main():
+    parser = make_parser(
+        "Compare loading cmudict.dict() with the memory-mapped syllable index")
+    parser.add_argument("--index", default="./assets/syllables.idx")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="interpreters to start for each loader, keeping the fastest")
+    args = parser.parse_args()
+
+    # Builds the index if it isn't there yet, so that isn't timed below
+    index = SyllableIndex(args.index)
+
+    for name, loader in LOADERS.items():
+        runs = [load(loader, args.index) for _ in range(args.runs)]
+        elapsed = min(r[0] for r in runs)
+        rss = min(r[1] for r in runs)
+        print(f"{name}: {elapsed * 1000:.1f} ms, {rss:.1f} MB peak RSS")
+
+    import cmudict
+    failures = []
+    dictionary = cmudict.dict()
+    for word, pronunciations in dictionary.items():
+        if not pronunciations:
+            continue
+        expected = sum(p[-1].isdigit() for p in pronunciations[0])
+        if index.get(word) != expected:
+            failures.append(
+                f"{word!r} has {index.get(word)} syllables in the index, not {expected}")
+    words = sum(1 for p in dictionary.values() if p)
+    if len(index) != words:
+        failures.append(f"the index has {len(index)} words, not {words}")
+    print(f"compared {len(index)} words")
+
+    finish(failures)
+
+
+if __name__ == "__main__":
+    main()
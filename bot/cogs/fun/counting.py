@@ -2,14 +2,18 @@ import ast
 import logging
 import re
 from contextlib import suppress
+from fractions import Fraction
+from functools import lru_cache
 
 from discord import (ApplicationContext, Embed, HTTPException, Message,
                      RawBulkMessageDeleteEvent, RawMessageDeleteEvent,
                      RawMessageUpdateEvent)
 from discord.commands import SlashCommandGroup
 from discord.ext.commands import BucketType, cooldown, guild_only
+from tools.bot import Anomaly
 from tools.cog import Cog
 from tools.colors import Colors
+from tools.counting import CountingEngine, FeedbackDispatcher
 
 logger = logging.getLogger("kosmo")
 
@@ -33,6 +37,36 @@ special_numbers = {
 }
 
 
+# Limits that keep checking a counting message's maths cheap
+MAX_LENGTH = 100
+MAX_NODES = 40
+MAX_BITS = 128
+MAX_EXPONENT = 10
+
+
+def estimate_bits(node):
+    """Upper bound on the size of an expression's exact result, in bits"""
+    match node:
+        case ast.Expression(body):
+            return estimate_bits(body)
+        case ast.BinOp(left, ast.Add() | ast.Sub(), right):
+            return estimate_bits(left) + estimate_bits(right) + 1
+        case ast.BinOp(left, ast.Mult() | ast.Div(), right):
+            return estimate_bits(left) + estimate_bits(right)
+        case ast.BinOp(left, ast.Pow(), right):
+            if estimate_bits(right) > MAX_BITS:
+                raise OverflowError
+            exponent = eval_ast(right)
+            if exponent.denominator != 1 or abs(exponent) > MAX_EXPONENT:
+                raise OverflowError
+            return estimate_bits(left) * max(abs(int(exponent)), 1)
+        case ast.Constant(int() | float() as x):
+            x = Fraction(str(x))
+            return x.numerator.bit_length() + x.denominator.bit_length()
+        case _:
+            raise ValueError("Operation Not Supported")
+
+
 def eval_ast(node):
     match node:
         case ast.Expression(body):
@@ -46,20 +80,36 @@ def eval_ast(node):
         case ast.BinOp(left, ast.Div(), right):
             return eval_ast(left) / eval_ast(right)
         case ast.BinOp(left, ast.Pow(), right):
-            if eval_ast(right) > 10:
-                raise OverflowError
-            return eval_ast(left) ** eval_ast(right)
-        case ast.Constant(x):
-            return x
+            return eval_ast(left) ** int(eval_ast(right))
+        case ast.Constant(int() | float() as x):
+            # Exact rationals, so 0.1+0.2 really is 0.3
+            return Fraction(str(x))
         case _:
             raise ValueError("Operation Not Supported")
 
 
+@lru_cache(maxsize=1024)
+def evaluate(expression: str):
+    """Exactly evaluate an expression, or None if it isn't allowed or is too expensive"""
+    with suppress(SyntaxError, OverflowError, ValueError, ZeroDivisionError):
+        tree = ast.parse(expression, mode="eval")
+
+        # Check the cost before doing any of the work
+        if sum(1 for _ in ast.walk(tree)) > MAX_NODES:
+            return None
+        if estimate_bits(tree) > MAX_BITS:
+            return None
+
+        return eval_ast(tree)
+
+
 def do_math(input: str):
     # If it's just a number, return it
-    if re.fullmatch(r"[0-9]", input):
+    if re.fullmatch(r"[0-9]+", input):
         return int(input)
-    # Otherwise, make sure that it matches our allowed characters
+    # Otherwise, make sure that it's short and matches our allowed characters
+    if len(input) > MAX_LENGTH:
+        return None
     if not re.fullmatch(r"[0-9()x^\-+./ ]+", input):
         return None
 
@@ -70,13 +120,58 @@ def do_math(input: str):
     input = re.sub(r"([0-9]|\))\(", r"\1*(", input)
 
     # Try to run the equation
-    with suppress(OverflowError, ValueError):
-        return eval_ast(ast.parse(input, mode="eval"))
+    result = evaluate(input)
+    if result is not None and result.denominator == 1:
+        return int(result)
+    return result
 
 
 class Counting(Cog, name="Counting"):
     """Counting module"""
 
+    def __init__(self, bot: Anomaly):
+        super().__init__(bot)
+        self.engine = CountingEngine(self.bot.database, self.count)
+        self.feedback = FeedbackDispatcher()
+        # Messages and raw events turned away by the counting channel index
+        self.skipped_lookups = 0
+        # guild ID -> the channel its state was counted in
+        self.channels = {}
+        self.bot.settings.subscribe("CountingSettings", self.settings_changed)
+        self.bot.loop.create_task(self.index_last_messages())
+
+    def cog_unload(self):
+        self.engine.close()
+        self.feedback.close()
+        self.bot.loop.create_task(self.engine.flush())
+
+    def cache_stats(self):
+        return {
+            "counting_feedback": self.feedback.stats(),
+            "counting_skipped_lookups": self.skipped_lookups
+        }
+
+    def settings_changed(self, guild_id: int):
+        """Forget a guild's state when its settings are deleted or it counts in another channel
+
+        Deleting the settings also deletes the guild's CountingData, which the
+        cached state would otherwise write back.
+        """
+        guildIDs = list(self.engine.states) if guild_id is None else [guild_id]
+        for guildID in guildIDs:
+            settings = self.bot.settings.peek("CountingSettings", guildID)
+            if not settings or settings.channel_id != self.channels.get(guildID):
+                self.engine.forget(guildID)
+                self.channels.pop(guildID, None)
+
+    async def index_last_messages(self):
+        await self.bot.wait_until_ready()
+        try:
+            await self.engine.index()
+        except:
+            logger.error(
+                "Failed to index the last counted messages", exc_info=True)
+
     RootGroup = SlashCommandGroup(
         "ct", "Commands related to Counting")
 
@@ -91,21 +186,16 @@ class Counting(Cog, name="Counting"):
         SELECT enabled FROM CountingSettings
         WHERE guild_id = %s;
         """
-        settings = self.bot.database.execute(
-            statement, (ctx.guild.id,), 1)
+        settings = await self.bot.database.fetchone(
+            statement, (ctx.guild.id,))
 
         if not settings or not settings[0]:
             await ctx.respond("The Counting module is disabled!", ephemeral=True)
             return
 
-        statement = """
-        SELECT next_number, highscore, last_counted_member_id FROM CountingData
-        WHERE guild_id = %s;
-        """
-        data = self.bot.database.execute(
-            statement, (ctx.guild.id,), 1)
+        state = await self.engine.state(ctx.guild.id)
 
-        if not data:
+        if state.next_number == 1 and not state.highscore:
             await ctx.respond("Nobody has started counting!", ephemeral=True)
             return
 
@@ -114,16 +204,17 @@ class Counting(Cog, name="Counting"):
         embed = Embed(title="Counting Stats", color=Colors.deep_blue())
 
         embed.add_field(name="Next Number",
-                        value=data[0], inline=True)
+                        value=state.next_number, inline=True)
 
-        lastCounted = ctx.guild.get_member(data[2])
+        lastCounted = ctx.guild.get_member(state.last_member_id)
         if lastCounted:
             embed.add_field(name="Last Counted",
                             value=lastCounted.mention, inline=True)
         else:
-            embed.add_field(name="Last Counted", value=data[2], inline=True)
+            embed.add_field(name="Last Counted",
+                            value=state.last_member_id, inline=True)
 
-        embed.add_field(name="Highscore", value=data[1], inline=False)
+        embed.add_field(name="Highscore", value=state.highscore, inline=False)
 
         await ctx.respond(embed=embed)
 
@@ -139,24 +230,30 @@ class Counting(Cog, name="Counting"):
         guild = message.guild
         channel = message.channel
 
-        statement = """
-        SELECT enabled, allow_math FROM CountingSettings
-        WHERE (guild_id = %s) AND (channel_id = %s);
-        """
-        settings = self.bot.database.execute(
-            statement, (guild.id, channel.id), 1)
+        if not self.bot.settings.watching("CountingSettings", channel.id):
+            self.skipped_lookups += 1
+            return
 
-        if not settings or not settings[0]:
+        settings = await self.bot.settings.get("CountingSettings", guild.id)
+
+        if not settings or not settings.enabled or settings.channel_id != channel.id:
             return
 
-        statement = """
-        SELECT next_number, highscore, last_counted_member_id FROM CountingData
-        WHERE guild_id = %s;
-        """
-        data = self.bot.database.execute(
-            statement, (guild.id,), 1) or (1, 0, None)
+        # Messages are counted one at a time, in order, by the channel's consumer
+        self.engine.submit(channel.id, message)
+
+    async def count(self, message: Message):
+        guild = message.guild
+
+        settings = await self.bot.settings.get("CountingSettings", guild.id)
+
+        if not settings or not settings.enabled or settings.channel_id != message.channel.id:
+            return
+
+        state = await self.engine.state(guild.id)
+        self.channels[guild.id] = settings.channel_id
 
-        if settings[1]:
+        if settings.allow_math:
             sentNumber = do_math(message.clean_content)
 
             # Ignore it if it isn't a number
@@ -166,10 +263,8 @@ class Counting(Cog, name="Counting"):
             elif sentNumber < 0:
                 return
             # Ignore it if it isn't an integer
-            elif isinstance(sentNumber, float):
-                if not sentNumber.is_integer():
-                    return
-                sentNumber = int(sentNumber)
+            elif isinstance(sentNumber, Fraction):
+                return
         else:
             sentNumber = message.clean_content
             if not re.fullmatch(r"[0-9]+", sentNumber):
@@ -177,103 +272,86 @@ class Counting(Cog, name="Counting"):
             sentNumber = int(sentNumber)
 
         description = None
-        if sentNumber != data[0]:
-            if data[0] == 1 and sentNumber != 1:
+        if sentNumber != state.next_number:
+            if state.next_number == 1 and sentNumber != 1:
                 return
-            description = f"{message.author.mention} can't count past {data[0]}!"
-        if message.author.id == data[2]:
+            description = f"{message.author.mention} can't count past {state.next_number}!"
+        if message.author.id == state.last_member_id:
             description = f"{message.author.mention} is trying to count alone!"
 
         if description:
             embed = Embed(title="Count Reset to 0",
                           description=description, color=Colors.deep_orange())
-            highscore = max(data[0]-1, data[1])
-            if highscore > data[1]:
-                embed.set_footer(text=f"New highscore of {highscore}!")
+            oldHighscore = state.highscore
+            state.reset()
+            if state.highscore > oldHighscore:
+                embed.set_footer(text=f"New highscore of {state.highscore}!")
             else:
-                embed.set_footer(text=f"Highscore: {highscore}")
-
-            statement = """
-            UPDATE CountingData
-                SET next_number = 1,
-                highscore = %s,
-                last_counted_member_id = NULL,
-                last_counted_message_id = NULL
-            WHERE guild_id = %s;
-            """
-            self.bot.database.execute(statement, (highscore, guild.id))
-
-            with suppress(HTTPException):
-                await message.add_reaction("❌")
-            with suppress(HTTPException):
-                await message.channel.send(embed=embed)
+                embed.set_footer(text=f"Highscore: {state.highscore}")
+
+            self.engine.changed(guild.id)
+
+            # Don't hold up the next message while Discord catches up
+            self.feedback.submit(message, ["❌"], embed)
 
         else:
-            statement = """
-            INSERT INTO CountingData VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT(guild_id) DO UPDATE
-                SET next_number = %s,
-                last_counted_member_id = %s,
-                last_counted_message_id = %s;
-            """
-            self.bot.database.execute(
-                statement, (guild.id, data[0]+1, 0, message.author.id, message.id, data[0]+1, message.author.id, message.id))
-
-            with suppress(HTTPException):
-                await message.add_reaction("✅")
-
-            if data[0]+1 in special_numbers.keys():
-                with suppress(HTTPException):
-                    await message.add_reaction(special_numbers[data[0]+1])
+            state.count(message.author.id, message.id)
+            self.engine.changed(guild.id)
+
+            # The number that was just counted
+            if sentNumber in special_numbers.keys():
+                self.feedback.submit(
+                    message, ["✅", special_numbers[sentNumber]])
+            else:
+                self.feedback.submit(message, ["✅"], skippable=True)
 
     async def prevent_trolling(self, payload):
-        statement = """
-        SELECT enabled, allow_math FROM CountingSettings
-        WHERE guild_id = %s AND channel_id = %s;
-        """
+        if not self.bot.settings.watching("CountingSettings", payload.channel_id):
+            self.skipped_lookups += 1
+            return
+
+        # Only the last counted message matters, which rules out almost every edit and delete
+        messageIDs = getattr(payload, "message_ids", None) or {payload.message_id}
+        if not self.engine.counted_last(payload.guild_id, messageIDs):
+            return
 
         channel = self.bot.get_channel(payload.channel_id)
         if not channel:
             return
 
-        settings = self.bot.database.execute(
-            statement, (payload.guild_id, channel.id), 1)
+        settings = await self.bot.settings.get("CountingSettings", payload.guild_id)
 
-        if not settings or not settings[0]:
+        if not settings or not settings.enabled or settings.channel_id != channel.id:
             return
 
-        statement = """
-        SELECT next_number, last_counted_member_id, last_counted_message_id FROM CountingData
-        WHERE guild_id = %s;
-        """
-        data = self.bot.database.execute(
-            statement, (payload.guild_id,), 1)
+        state = await self.engine.state(payload.guild_id)
 
-        if not data or data[0] == 1:
+        if state.next_number == 1:
             return
 
-        if hasattr(payload, "message_ids") and data[2] not in payload.message_ids:
-            return
-        elif data[2] != payload.message_id:
+        if state.last_message_id not in messageIDs:
             return
 
-        author = await self.bot.get_or_fetch_user(data[1])
+        # The channel's consumer may count more messages while we wait, which makes this warning moot
+        lastMessageID = state.last_message_id
+
+        author = await self.bot.get_or_fetch_user(state.last_member_id)
         if author:
             author = author.mention
         else:
-            author = data[1]
+            author = state.last_member_id
+
+        if state.last_message_id != lastMessageID:
+            return
 
+        msg = None
         with suppress(HTTPException):
-            msg = None
-            msg = await channel.send(f"⚠️ Next Number: **{data[0]}**\nLast Counted: {author}")
+            msg = await channel.send(f"⚠️ Next Number: **{state.next_number}**\nLast Counted: {author}")
 
-        statement = """
-        UPDATE CountingData
-            SET last_counted_message_id = %s
-        WHERE guild_id = %s;
-        """
-        self.bot.database.execute(
-            statement, (msg.id, payload.guild_id))
+        # Don't overwrite a count that was made while the warning was sent
+        if msg and state.last_message_id == lastMessageID:
+            state.last_message_id = msg.id
+            self.engine.changed(payload.guild_id)
 
     @Cog.listener()
     async def on_raw_message_edit(self, payload: RawMessageUpdateEvent):
@@ -1,45 +1,91 @@
+import asyncio
+import logging
 import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import suppress
+from functools import lru_cache
+from os import getenv
 
-import cmudict
 import syllables
 from discord import ButtonStyle, Embed, HTTPException, Message, TextChannel
 from discord.ui import Button, View
 from discord.utils import escape_markdown
 from num2words import num2words
+from tools.bot import Anomaly
 from tools.cog import Cog
 from tools.colors import Colors
+from tools.syllables import SyllableIndex
 
 # Haiku detection adapted from https://www.kaggle.com/lazovich/headline-haiku-detection
 
-syllableDictionary = cmudict.dict()
+logger = logging.getLogger("kosmo")
+
+syllableDictionary = SyllableIndex()
+
+
+# Stripped one kind at a time in this order, which decides how runs like "***" are read
+markdownPatterns = [(delimiter, re.compile(pattern)) for delimiter, pattern in (
+    ("__", r"(__){1}([\s\S]+)(__){1}"),
+    ("_", r"(_){1}([\s\S]+)(_){1}"),
+    ("**", r"(\*\*){1}([\s\S]+)(\*\*){1}"),
+    ("*", r"(\*){1}([\s\S]+)(\*){1}"),
+    ("~~", r"(~~){1}([\s\S]+)(~~){1}"),
+    ("||", r"(\|\|){1}([\s\S]+)(\|\|){1}"),
+    ("```", r"(```){1}([\s\S]+)(```){1}"),
+    ("`", r"(`){1}([\s\S]+)(`){1}")
+)]
 
 
 def delete_markdown(text: str):
-    underlined = r"(__){1}([\s\S]+)(__){1}"
-    italics1 = r"(_){1}([\s\S]+)(_){1}"
-    italics2 = r"(\*){1}([\s\S]+)(\*){1}"
-    bold = r"(\*\*){1}([\s\S]+)(\*\*){1}"
-    strikethrough = r"(~~){1}([\s\S]+)(~~){1}"
-    spoiler = r"(\|\|){1}([\s\S]+)(\|\|){1}"
-    codeBlock = r"(```){1}([\s\S]+)(```){1}"
-    code = r"(`){1}([\s\S]+)(`){1}"
-    markdownRegex = [underlined, italics1, bold,
-                     italics2, strikethrough, spoiler, codeBlock, code]
-
-    for type in markdownRegex:
-        while re.findall(type, text):
-            text = re.sub(type, r"\2", text)
+    """Remove paired markdown delimiters, each kind from the outside in"""
+    for delimiter, pattern in markdownPatterns:
+        # Most messages don't have any markdown
+        if delimiter not in text:
+            continue
+        replaced = 1
+        while replaced:
+            text, replaced = pattern.subn(r"\2", text)
     return text
 
 
+# Haikus have 17 syllables, and every word has at least one
+MIN_WORDS = 3
+MAX_WORDS = 17
+MAX_LENGTH = 500
+
+allowedCharacters = re.compile(
+    r"[a-zA-Z0-9 (){}[\]\"\*'+\-$%#@!\^&,;:?!\.]+")
+# The allowed characters plus markdown and new lines, to rule messages out before any other work
+allowedRawCharacters = re.compile(
+    r"[a-zA-Z0-9 (){}[\]\"\*'+\-$%#@!\^&,;:?!\.\n_~|`]+")
+
+
+@lru_cache(maxsize=65536)
+def word_syllables(word: str):
+    # Check if word is in the dictionary
+    syls = syllableDictionary.get(word)
+
+    if syls is None:
+        return syllables.estimate(word)
+    return syls
+
+
+@lru_cache(maxsize=4096)
+def number_words(number: str):
+    """A number's word-form, e.g. ("twenty", "one") for "21", or None if it can't be read out"""
+    try:
+        return tuple(num2words(number).replace("-", " ").split(" "))
+    except:
+        return None
+
+
 def count_syllables(word: str):
 
     # Convert the number into its word-form if possible
     if word.isnumeric():
-        try:
-            words = num2words(word).replace("-", " ").split(" ")
-        except:
+        words = number_words(word)
+        if words is None:
             return None
     else:
         words = word.replace("-", " ").split(" ")
@@ -47,19 +93,26 @@ def count_syllables(word: str):
     totalSyllables = 0
 
     for thisWord in words:
-        # Check if word is in the dictionary
-        syls = syllableDictionary[thisWord]
-
-        if not len(syls):
-            totalSyllables = syllables.estimate(thisWord)
-        else:
-            for sound in syls[0]:
-                if sound[-1].isdigit():
-                    totalSyllables += 1
+        totalSyllables += word_syllables(thisWord)
 
     return totalSyllables
 
 
+def syllable_stats():
+    """Hit rates of the memoized word and number lookups, shared by every server"""
+    stats = {}
+    for name, cache in (("words", word_syllables), ("numbers", number_words)):
+        info = cache.cache_info()
+        lookups = info.hits + info.misses
+        stats[name] = {
+            "size": info.currsize,
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": info.hits / lookups if lookups else 0.0
+        }
+    return stats
+
+
 def is_haiku(text: str):
     words = text.split(" ")
 
@@ -100,6 +153,10 @@ def is_haiku(text: str):
             haikuParts[1] = thisGroup
             thisGroup = []
 
+        # Past the line we're on, so the rest of the words can't be counted in
+        if totalSyllables > (7 if hit_5 and not hit_7 else 5):
+            return False
+
         i += 1
 
     # If we hit 5 and 7 and there are only 5
@@ -111,9 +168,152 @@ def is_haiku(text: str):
     return False
 
 
+def might_be_haiku(content: str):
+    """Rule out most messages before doing any real work"""
+    return len(content) <= MAX_LENGTH and bool(allowedRawCharacters.fullmatch(content))
+
+
+def find_haiku(content: str):
+    """The three lines of the haiku in a message, or None if it isn't one"""
+
+    if not might_be_haiku(content):
+        return None
+
+    # remove markdown
+    content = delete_markdown(content.replace("\n", " "))
+
+    # remove double spaces
+    content = re.sub(r" +", " ", content)
+
+    # check if all characters are stuff that we want
+    if not allowedCharacters.fullmatch(content):
+        return None
+
+    # change stuff like "5.0" to "5 point 0"
+    haikuReady = re.sub(r"([0-9]){1}\.([0-9]){1}", r"\1 point \2", content)
+
+    # Remove punctuation and other bad characters
+    haikuReady = re.sub(r"[^\s\w-]", "", haikuReady)
+    haikuReady = re.sub(r" +", " ", haikuReady).strip()
+
+    if not len(haikuReady):
+        return None
+
+    haikuWords = haikuReady.split(" ")
+    if not MIN_WORDS <= len(haikuWords) <= MAX_WORDS:
+        return None
+
+    parts = is_haiku(haikuReady)
+    if parts is False:
+        return None
+
+    words = content.split(" ")
+
+    return [" ".join([words[i] for i in part]) for part in parts]
+
+
+def find_haikus(contents: list):
+    """find_haiku() for a batch of messages, in a worker process"""
+    return [find_haiku(content) for content in contents]
+
+
 class Haiku(Cog, name="Haiku"):
     """Haiku module"""
 
+    def __init__(self, bot: Anomaly, workers: int = None):
+        super().__init__(bot)
+
+        # Detection runs in worker processes if HAIKU_WORKERS is set, otherwise on the event loop.
+        # Each worker maps the syllable index once, when it imports this module
+        self.workers = workers or int(getenv("HAIKU_WORKERS") or 0)
+        self.pool = ProcessPoolExecutor(
+            self.workers) if self.workers else None
+
+        # (content, future) waiting to be sent to a worker
+        self.pending = []
+        self.batcher = None
+
+    def cog_unload(self):
+        if self.batcher:
+            self.batcher.cancel()
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def cache_stats(self):
+        # Each worker process has its own caches, which aren't visible from here
+        if self.pool:
+            return {}
+        return {"haiku_syllables": syllable_stats()}
+
+    async def detect(self, content: str):
+        if not self.pool:
+            return find_haiku(content)
+
+        # Not worth sending to a worker
+        if not might_be_haiku(content):
+            return None
+
+        future = self.bot.loop.create_future()
+        self.pending.append((content, future))
+        if not self.batcher or self.batcher.done():
+            self.batcher = self.bot.loop.create_task(self.send_batches())
+        return await future
+
+    async def send_batches(self):
+        while self.pending:
+            # Give a few more messages a chance to join the batch
+            if len(self.pending) < 100:
+                await asyncio.sleep(0.02)
+            batch, self.pending = self.pending[:100], self.pending[100:]
+
+            # Batches run side by side, one per free worker
+            pool = self.pool
+            try:
+                result = self.bot.loop.run_in_executor(
+                    pool, find_haikus, [content for content, _ in batch])
+            except BrokenProcessPool:
+                self.restart_pool(pool)
+                self.detect_here(batch)
+                continue
+            result.add_done_callback(
+                lambda result, batch=batch, pool=pool: self.resolve(batch, result, pool))
+
+    def restart_pool(self, pool: ProcessPoolExecutor):
+        """Replace a pool whose worker died, unless that's already been done"""
+        if self.pool is not pool:
+            return
+        logger.error("A Haiku worker process died, restarting the pool")
+        pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = ProcessPoolExecutor(self.workers)
+
+    @staticmethod
+    def detect_here(batch: list):
+        """Detect a batch on the event loop, when the workers can't"""
+        for content, future in batch:
+            if not future.done():
+                future.set_result(find_haiku(content))
+
+    def resolve(self, batch: list, result: asyncio.Future, pool: ProcessPoolExecutor):
+        if result.cancelled():
+            for _, future in batch:
+                future.cancel()
+            return
+
+        error = result.exception()
+        # The batch was lost with its worker, rather than failing by itself
+        if isinstance(error, BrokenProcessPool):
+            self.restart_pool(pool)
+            self.detect_here(batch)
+            return
+
+        for i, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result.result()[i])
+
     @Cog.listener()
     async def on_message(self, message: Message):
         if message.author.bot:
@@ -125,45 +325,16 @@ class Haiku(Cog, name="Haiku"):
 
         guild = message.guild
 
-        statement = """
-        SELECT enabled, channel_id, announce, react FROM HaikuSettings
-        WHERE guild_id = %s;
-        """
-        settings = self.bot.database.execute(
-            statement, (guild.id,), 1)
-
-        if not settings or not settings[0]:
-            return
-
-        # remove markdown
-        content = delete_markdown(message.clean_content.replace("\n", " "))
+        settings = await self.bot.settings.get("HaikuSettings", guild.id)
 
-        # remove double spaces
-        content = re.sub(r" +", " ", content)
-
-        # check if all characters are stuff that we want
-        if not re.fullmatch(r"[a-zA-Z0-9 (){}[\]\"\*'+\-$%#@!\^&,;:?!\.]+", content):
-            return
-
-        # change stuff like "5.0" to "5 point 0"
-        haikuReady = re.sub(r"([0-9]){1}\.([0-9]){1}", r"\1 point \2", content)
-
-        # Remove punctuation and other bad characters
-        haikuReady = re.sub(r"[^\s\w-]", "", haikuReady)
-        haikuReady = re.sub(r" +", " ", haikuReady).strip()
-
-        if not len(haikuReady):
+        if not settings or not settings.enabled:
             return
 
-        parts = is_haiku(haikuReady)
-        if parts is False:
+        lines = await self.detect(message.clean_content)
+        if not lines:
             return
 
-        words = content.split(" ")
-
-        firstLine = escape_markdown(" ".join([words[i] for i in parts[0]]))
-        secondLine = escape_markdown(" ".join([words[i] for i in parts[1]]))
-        thirdLine = escape_markdown(" ".join([words[i] for i in parts[2]]))
+        firstLine, secondLine, thirdLine = map(escape_markdown, lines)
 
         haiku = f"*{firstLine}*\n*{secondLine}*\n*{thirdLine}*"
 
@@ -171,9 +342,9 @@ class Haiku(Cog, name="Haiku"):
         embed.set_footer(text=f"- {message.author.name}",
                          icon_url=message.author.avatar.url)
 
-        if settings[1]:
+        if settings.channel_id:
             haikuChannel = self.bot.get_partial_messageable(
-                settings[1], type=TextChannel)
+                settings.channel_id, type=TextChannel)
 
             view = View()
             url = message.jump_url.replace("@me", str(guild.id))
@@ -183,11 +354,11 @@ class Haiku(Cog, name="Haiku"):
             with suppress(HTTPException):
                 await haikuChannel.send(embed=embed, view=view)
 
-        if settings[2]:
+        if settings.announce:
             with suppress(HTTPException):
                 await message.reply(embed=embed, mention_author=False)
 
-        if settings[3]:
+        if settings.react:
             with suppress(HTTPException):
                 await message.add_reaction("📜")
 
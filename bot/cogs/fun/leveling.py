@@ -1,32 +1,67 @@
+import asyncio
 import math
+from array import array
+from bisect import bisect_right
 from contextlib import suppress
 from datetime import datetime
 from math import ceil as round_up
 from random import randint
 
+import numpy as np
 from discord import (ApplicationContext, Embed, Guild, HTTPException, Member,
                      Message)
 from discord.commands import Option, SlashCommandGroup, user_command
 from discord.ext.commands import (BucketType, cooldown, guild_only,
                                   has_guild_permissions)
+from discord.ext.tasks import loop
 from tools.bot import Anomaly
 from tools.cog import Cog
 from tools.colors import Colors
+from tools.cooldowns import CooldownMap
+from tools.ledger import ExperienceLedger
+from tools.ranks import RankIndex
 from tools.tools import CustomPaginator, make_progress_bar
 
 
+# Highest level covered by the precomputed XP threshold table
+MAX_LEVEL = 1000
+
+
 def get_xp(level: int):
     return math.floor(2*(level**3)+200*level)
 
 
+def build_xp_table(max_level: int = MAX_LEVEL):
+    """XP needed for each level from 0 to max_level"""
+    return array("q", (get_xp(level) for level in range(max_level + 1)))
+
+
+xp_table = build_xp_table()
+xp_thresholds = np.frombuffer(xp_table, dtype=np.int64)
+
+
 def get_level(xp: int):
-    level = 0
-    while get_xp(level) <= xp:
-        level += 1
-    return level - 1
+    level = bisect_right(xp_table, xp) - 1
+
+    # Past the end of the table, keep walking the curve
+    if level == len(xp_table) - 1:
+        while get_xp(level + 1) <= xp:
+            level += 1
+    return level
+
+
+def get_levels(xps):
+    """Vectorized get_level for recomputing many members at once"""
+    xps = np.asarray(xps, dtype=np.int64)
+    levels = np.searchsorted(xp_thresholds, xps, side="right") - 1
 
+    # Rare members past the end of the table
+    for i in np.flatnonzero(levels == len(xp_table) - 1):
+        levels[i] = get_level(int(xps[i]))
+    return levels
 
-def level_embed(member: Member, level: int, xp: int):
+
+def level_embed(member: Member, level: int, xp: int, rank: int = None):
     xpStart = get_xp(level)
     xpEnd = get_xp(level+1)
 
@@ -41,30 +76,133 @@ def level_embed(member: Member, level: int, xp: int):
     embed.add_field(name=f"{xp} Experience"[:256],
                     value=f"{progressBar}\n{xpEnd-xp} Experience remaining to level up"[:1024], inline=True)
 
+    if rank:
+        embed.set_footer(text=f"Rank #{rank}")
+
     return embed
 
 
+# Statements run for every eligible message, prepared through the database's statement registry
+statements = {
+    "leveling.roles": """
+    SELECT role_id, required_level FROM LevelingRoles
+    WHERE guild_id = %s
+    ORDER BY required_level ASC;
+    """
+}
+
+
 class Leveling(Cog, name="Leveling"):
     """Leveling module"""
 
     def __init__(self, bot: Anomaly):
         super().__init__(bot)
-        self.leveling_cooldowns = {}
+        self.bot.database.register(statements)
+        self.leveling_cooldowns = CooldownMap(60)
+        self.ranks = RankIndex(self.bot.database)
+        self.ledger = ExperienceLedger(
+            self.bot.database, get_level, on_change=self.ranks.update)
+
+        # guild ID -> [(role ID, required level)], sorted by required level
+        self.reward_roles = {}
+        self.bot.settings.subscribe("LevelingRoles", self.forget_reward_roles)
+        # (guild ID, member ID) of members whose reward roles are about to be updated
+        self.role_updates = set()
+        self.flush_experience.start()
+
+    def cog_unload(self):
+        self.flush_experience.cancel()
+        self.bot.loop.create_task(self.ledger.flush())
+
+    def cache_stats(self):
+        return {"leveling_cooldowns": self.leveling_cooldowns.stats()}
+
+    # Write gained XP to the database in batches
+    @loop(seconds=15)
+    async def flush_experience(self):
+        await self.ledger.flush()
+
+    @flush_experience.before_loop
+    async def before_flush_experience(self):
+        await self.bot.wait_until_ready()
+
+    async def get_ranks(self, guild: Guild):
+        """Get a guild's leaderboard, loading it if this is the first time"""
+        if guild.id not in self.ranks.guilds:
+            # The guild is loaded from the database, so it has to be up to date
+            await self.ledger.flush()
+        return await self.ranks.get(guild)
+
+    def forget_reward_roles(self, guild_id: int):
+        if guild_id is None:
+            self.reward_roles.clear()
+        else:
+            self.reward_roles.pop(guild_id, None)
+
+    async def get_reward_roles(self, guild: Guild):
+        rewardRoles = self.reward_roles.get(guild.id)
+        if rewardRoles is None:
+            rewardRoles = await self.bot.database.fetchall(
+                "leveling.roles", (guild.id,)) or []
+            self.reward_roles[guild.id] = rewardRoles
+        return rewardRoles
+
+    def reward_role_changes(self, member: Member, level: int, rewardRoles: list, stack_roles: bool):
+        """The member's full list of roles once their reward roles match their level, or None if nothing changes"""
+        useableRoles = []
+        for roleID, requiredLevel in rewardRoles:
+            roleObj = member.guild.get_role(roleID)
+            if roleObj and roleObj.is_assignable():
+                useableRoles.append((roleObj, requiredLevel))
+
+        earnedRoles = [i[0] for i in useableRoles if i[1] <= level]
+        if not stack_roles:
+            earnedRoles = earnedRoles[-1:]
+
+        currentRoles = [r for r in member.roles if not r.is_default()]
+        unearnedRoles = {i[0] for i in useableRoles} - set(earnedRoles)
+
+        newRoles = [r for r in currentRoles if r not in unearnedRoles]
+        newRoles += [r for r in earnedRoles if r not in currentRoles]
+
+        if set(newRoles) == set(currentRoles):
+            return None
+        return newRoles
+
+    def schedule_reward_roles(self, member: Member):
+        """Update a member's reward roles shortly, once for any number of calls in the meantime"""
+        key = (member.guild.id, member.id)
+        if key not in self.role_updates:
+            self.role_updates.add(key)
+            self.bot.loop.create_task(self.update_reward_roles(member))
+
+    async def update_reward_roles(self, member: Member):
+        guild = member.guild
+        try:
+            await asyncio.sleep(2)
+        finally:
+            self.role_updates.discard((guild.id, member.id))
+
+        member = guild.get_member(member.id)
+        settings = await self.bot.settings.get("LevelingSettings", guild.id)
+        if not member or not settings or not settings.enabled:
+            return
+        if not guild.me.guild_permissions.manage_roles:
+            return
+
+        experience, level = await self.ledger.get(guild.id, member.id)
+        rewardRoles = await self.get_reward_roles(guild)
+
+        # Work the changes out again, in case anything changed while we waited
+        newRoles = self.reward_role_changes(
+            member, level, rewardRoles, settings.stack_roles)
+        if newRoles is not None:
+            with suppress(HTTPException):
+                await member.edit(roles=newRoles, reason="Updating Leveling Reward Roles")
 
     def handle_cooldown(self, guild: Guild, member: Member, dt: datetime):
         """Handles the 1-minute leveling cooldown"""
-        guildCooldowns = self.leveling_cooldowns.get(guild.id)
-        if not guildCooldowns:
-            self.leveling_cooldowns[guild.id] = {member.id: dt}
-            return True
-        oldDT = guildCooldowns.get(member.id)
-        if not oldDT:
-            self.leveling_cooldowns[guild.id][member.id] = dt
-            return True
-        if (dt-oldDT).total_seconds() < 60:
-            return False
-        self.leveling_cooldowns[guild.id][member.id] = dt
-        return True
+        return self.leveling_cooldowns.trigger((guild.id, member.id), dt.timestamp())
 
     RootGroup = SlashCommandGroup(
         "lvl", "Commands related to the Leveling module")
@@ -85,19 +223,15 @@ class Leveling(Cog, name="Leveling"):
         SELECT enabled FROM LevelingSettings
         WHERE guild_id = %s;
         """
-        settings = self.bot.database.execute(
-            statement, (ctx.guild.id,), 1)
+        settings = await self.bot.database.fetchone(
+            statement, (ctx.guild.id,))
 
         if not settings or not settings[0]:
             await ctx.respond("The Leveling module is disabled!", ephemeral=True)
             return
 
-        statement = """
-        DELETE FROM MemberExperience
-        WHERE guild_id = %s AND member_id = %s;
-        """
-
-        self.bot.database.execute(statement, (ctx.guild.id, member.id))
+        await self.ledger.reset(ctx.guild.id, member.id)
+        self.ranks.remove(ctx.guild.id, member.id)
 
         await ctx.edit(content=f"{member.mention}'s level has been reset!", view=None)
 
@@ -114,8 +248,8 @@ class Leveling(Cog, name="Leveling"):
         SELECT enabled FROM LevelingSettings
         WHERE guild_id = %s;
         """
-        settings = self.bot.database.execute(
-            statement, (ctx.guild.id,), 1)
+        settings = await self.bot.database.fetchone(
+            statement, (ctx.guild.id,))
 
         if not settings or not settings[0]:
             await ctx.respond("The Leveling module is disabled!", ephemeral=True)
@@ -123,14 +257,7 @@ class Leveling(Cog, name="Leveling"):
 
         xp = get_xp(level)
 
-        statement = """
-        INSERT INTO MemberExperience(guild_id, member_id, experience, level)
-        VALUES (%s, %s, %s, %s)  ON CONFLICT (guild_id, member_id) DO UPDATE
-            SET experience = %s,
-            level = %s;
-        """
-        self.bot.database.execute(
-            statement, (ctx.guild.id, member.id, xp, level, xp, level))
+        self.ledger.set(ctx.guild.id, member.id, xp, level)
 
         await ctx.edit(content=f"{member.mention}'s level has been updated to **Level {level}!**", view=None)
 
@@ -151,21 +278,17 @@ class Leveling(Cog, name="Leveling"):
         SELECT enabled FROM LevelingSettings
         WHERE guild_id = %s;
         """
-        settings = self.bot.database.execute(
-            statement, (ctx.guild.id,), 1)
+        settings = await self.bot.database.fetchone(
+            statement, (ctx.guild.id,))
 
         if not settings or not settings[0]:
             await ctx.respond("The Leveling module is disabled!", ephemeral=True)
             return
 
-        statement = """
-        SELECT FROM MemberExperience VALUES (experience, level)
-        WHERE guild_id = %s AND member_id = %s;
-        """
-        data = self.bot.database.execute(
-            statement, (ctx.guild.id, member.id), 1) or (0, 0)
+        data = await self.ledger.get(ctx.guild.id, member.id)
+        ranks = await self.get_ranks(ctx.guild)
 
-        embed = level_embed(member, data[1], data[0])
+        embed = level_embed(member, data[1], data[0], ranks.rank(member.id))
 
         await ctx.respond(embed=embed, ephemeral=True)
 
@@ -184,28 +307,54 @@ class Leveling(Cog, name="Leveling"):
         SELECT enabled FROM LevelingSettings
         WHERE guild_id = %s;
         """
-        settings = self.bot.database.execute(
-            statement, (ctx.guild.id,), 1)
+        settings = await self.bot.database.fetchone(
+            statement, (ctx.guild.id,))
 
         if not settings or not settings[0]:
             await ctx.respond("The Leveling module is disabled!", ephemeral=True)
             return
 
-        statement = """
-        SELECT FROM MemberExperience VALUES (experience, level)
-        WHERE guild_id = %s AND member_id = %s;
-        """
-        data = self.bot.database.execute(
-            statement, (ctx.guild.id, user.id), 1) or (0, 0)
+        data = await self.ledger.get(ctx.guild.id, user.id)
+        ranks = await self.get_ranks(ctx.guild)
 
-        embed = level_embed(user, data[1], data[0])
+        embed = level_embed(user, data[1], data[0], ranks.rank(user.id))
 
         await ctx.respond(embed=embed, ephemeral=True)
 
+    @RootGroup.command(name="recompute")
+    @cooldown(1, 300, BucketType.guild)
+    @has_guild_permissions(administrator=True)
+    @guild_only()
+    async def recompute_levels(self, ctx: ApplicationContext, all_servers: Option(bool, "Recompute every server's levels (bot owner only)", required=False, default=False)):
+        """Recompute every member's level from their experience"""
+
+        await ctx.defer(ephemeral=True)
+
+        if all_servers and not await self.bot.is_owner(ctx.author):
+            await ctx.respond("Only the bot owner can recompute every server's levels!", ephemeral=True)
+            return
+
+        guildID = None if all_servers else ctx.guild.id
+
+        # Runs inside the recompute's transaction, so a failed edit mustn't roll it back
+        async def progress(done: int, total: int):
+            progressBar = make_progress_bar(done / total if total else 1)
+            with suppress(HTTPException):
+                await ctx.edit(content=f"Recomputing levels...\n{progressBar} {done}/{total} members")
+
+        changed = await self.ledger.recompute(get_levels, guildID, progress=progress)
+
+        if all_servers:
+            self.ranks.clear()
+        else:
+            self.ranks.discard_guild(ctx.guild.id)
+
+        await ctx.edit(content=f"Levels recomputed! {changed} members had the wrong level.")
+
     @RootGroup.command(name="leaderboard")
     @cooldown(1, 30, BucketType.member)
     @guild_only()
-    async def leaderboard(self, ctx: ApplicationContext):
+    async def leaderboard(self, ctx: ApplicationContext, page: Option(int, "Page to start from", min_value=1, required=False, default=1)):
         """View the server's leveling leaderboard"""
 
         await ctx.defer(ephemeral=True)
@@ -214,46 +363,53 @@ class Leveling(Cog, name="Leveling"):
         SELECT enabled FROM LevelingSettings
         WHERE guild_id = %s;
         """
-        settings = self.bot.database.execute(
-            statement, (ctx.guild.id,), 1)
+        settings = await self.bot.database.fetchone(
+            statement, (ctx.guild.id,))
 
         if not settings or not settings[0]:
             await ctx.respond("The Leveling module is disabled!", ephemeral=True)
             return
 
-        statement = """
-        SELECT member_id, experience, level FROM MemberExperience
-        WHERE guild_id = %s
-        ORDER BY level DESC, experience DESC, member_id ASC
-        LIMIT 120; 
-        """
+        ranks = await self.get_ranks(ctx.guild)
 
-        memberLevels = self.bot.database.execute(
-            statement, (ctx.guild.id,), count=-1)
+        # Show up to 10 pages, starting from the requested one
+        start = (page - 1) * 12
+        memberLevels = ranks.page(start, start + 120)
+
+        if not memberLevels:
+            await ctx.respond(f"The leaderboard only has {len(ranks)} members!", ephemeral=True)
+            return
 
         embeds = []
         fieldCounter = 0
-        position = 1
+        position = start + 1
         baseEmbed = Embed(title="Leveling Leaderboard",
                           color=Colors.better_neon_green())
 
+        authorRank = ranks.rank(ctx.author.id)
+        if authorRank:
+            baseEmbed.set_footer(
+                text=f"You are #{authorRank} of {len(ranks)}")
+
         embed = baseEmbed.copy()
         for thisMember in memberLevels:
             memberObject = ctx.guild.get_member(thisMember[0])
             if memberObject:
                 name = memberObject.mention
+            else:
+                name = thisMember[0]
 
-                embed.add_field(name=f"Position #{position}",
-                                value=f"{name}\n```Level {thisMember[2]}\n{thisMember[1]} Experience```", inline=True)
-                fieldCounter += 1
-                position += 1
+            embed.add_field(name=f"Position #{position}",
+                            value=f"{name}\n```Level {thisMember[2]}\n{thisMember[1]} Experience```", inline=True)
+            fieldCounter += 1
+            position += 1
 
             if fieldCounter == 12:
                 fieldCounter = 0
                 embeds.append(embed)
                 embed = baseEmbed.copy()
 
-        if embed not in embeds:
+        if fieldCounter:
             embeds.append(embed)
 
         if len(embeds) == 1:
@@ -264,6 +420,22 @@ class Leveling(Cog, name="Leveling"):
 
         await paginator.respond(ctx.interaction, ephemeral=True)
 
+    @Cog.listener()
+    async def on_member_remove(self, member: Member):
+        self.ranks.remove(member.guild.id, member.id)
+
+    @Cog.listener()
+    async def on_member_join(self, member: Member):
+        if member.bot or member.guild.id not in self.ranks.guilds:
+            return
+        experience, level = await self.ledger.get(member.guild.id, member.id)
+        if experience:
+            self.ranks.update(member.guild.id, member.id, experience, level)
+
+    @Cog.listener()
+    async def on_guild_remove(self, guild: Guild):
+        self.ranks.discard_guild(guild.id)
+
     @Cog.listener()
     async def on_message(self, message: Message):
 
@@ -282,78 +454,30 @@ class Leveling(Cog, name="Leveling"):
         if not self.handle_cooldown(message.guild, message.author, message.created_at):
             return
 
-        statement = """
-        SELECT enabled, multiplier, stack_roles, blacklisted_role_id, announce FROM LevelingSettings
-        WHERE guild_id = %s;
-        """
-
-        settings = self.bot.database.execute(statement, (guild.id,), 1)
+        settings = await self.bot.settings.get("LevelingSettings", guild.id)
 
-        if not settings or not settings[0]:
+        if not settings or not settings.enabled:
             return
 
-        if settings[3] in [r.id for r in message.author.roles]:
+        if settings.blacklisted_role_id in [r.id for r in message.author.roles]:
             return
 
-        statement = """
-        SELECT FROM MemberExperience VALUES (experience, level)
-        WHERE guild_id = %s AND member_id = %s;
-        """
-        data = self.bot.database.execute(
-            statement, (guild.id, message.author.id), 1) or (0, 0)
-
-        # random xp gain
-        gain = randint(15, 25) * settings[1]
-        newXP = round_up(gain + data[0])
-
-        # calculate what level the member needs to be at
-        newLevel = get_level(newXP)
+        # random xp gain, written to the database by the next flush
+        gain = round_up(randint(15, 25) * settings.multiplier)
+        oldLevel, newLevel, newXP = await self.ledger.add(guild.id, message.author.id, gain)
 
         # level up if the new level is different from the old level
-        if newLevel > data[1]:
-            data[1] = newLevel
-            if settings[4]:
+        if newLevel > oldLevel:
+            if settings.announce:
                 with suppress(HTTPException):
                     await message.channel.send(f"{message.author.mention} has leveled up to level **{newLevel}**!")
 
         # add leveling reward roles
         if message.guild.me.guild_permissions.manage_roles:
+            rewardRoles = await self.get_reward_roles(guild)
 
-            statement = """
-            SELECT role_id, required_level FROM LevelingRoles
-            WHERE guild_id = %s
-            ORDER BY required_level ASC;
-            """
-
-            levelingRoles = self.bot.database.execute(
-                statement, (guild.id,), count=-1)
-
-            useableRoles = []
-            for thisRole in levelingRoles:
-                roleObj = message.guild.get_role(thisRole[0])
-                if roleObj and roleObj.is_assignable():
-                    useableRoles.append((roleObj, thisRole[1]))
-
-            earnedRoles = [i[0] for i in useableRoles if i[1] <= data[1]]
-            if settings[2] and len(earnedRoles):
-                with suppress(HTTPException):
-                    await message.author.add_roles(*earnedRoles, reason="Adding Leveling Reward Roles")
-
-            else:
-                await message.author.remove_roles(*[i[0] for i in useableRoles], reason="Removing old Leveling Reward Roles")
-                if len(earnedRoles):
-                    with suppress(HTTPException):
-                        await message.author.add_roles(earnedRoles[-1], reason=f"Adding Leveling Reward Role")
-
-        statement = """
-        INSERT INTO MemberExperience(guild_id, member_id, experience, level)
-        VALUES (%s, %s, %s, %s) ON CONFLICT (guild_id, member_id) 
-            DO UPDATE
-                SET experience = %s,
-                level = %s;
-        """
-        self.bot.database.execute(
-            statement, (guild.id, message.author.id, newXP, newLevel, newXP, newLevel))
+            if self.reward_role_changes(message.author, newLevel, rewardRoles, settings.stack_roles) is not None:
+                self.schedule_reward_roles(message.author)
 
 
 def setup(bot):
@@ -174,6 +174,11 @@ class Music(Cog, name="Music"):
 
     @Cog.listener()
     async def on_socket_raw_receive(self, msg):
+        # Only voice updates matter, so skip parsing every other frame.
+        # Anything that slips through is still checked after parsing
+        if "VOICE_S" not in msg:
+            return
+
         data = json.loads(msg)
 
         if not data or "t" not in data:
@@ -1,13 +1,25 @@
+import asyncio
+import logging
 import math
 from contextlib import suppress
 
-from discord import (ButtonStyle, Embed, HTTPException, Message, PartialEmoji,
-                     RawReactionActionEvent, RawReactionClearEmojiEvent,
-                     RawReactionClearEvent)
+from discord import (ApplicationContext, ButtonStyle, Embed, HTTPException,
+                     Message, NotFound, Object, PartialEmoji,
+                     RawMessageUpdateEvent, RawReactionActionEvent,
+                     RawReactionClearEmojiEvent, RawReactionClearEvent,
+                     TextChannel)
+from discord.commands import Option, SlashCommandGroup
+from discord.ext.commands import (BucketType, cooldown, guild_only,
+                                  has_guild_permissions)
 from discord.ui import Button, View
-from discord.utils import get
+from discord.utils import get, parse_time
+from tools.bot import Anomaly
 from tools.cog import Cog
 from tools.colors import Colors
+from tools.starboard import RenderCache, RequestBudget, StarCounter
+from tools.tools import make_progress_bar
+
+logger = logging.getLogger("kosmo")
 
 
 def min_stars(requirement: int):
@@ -39,34 +51,56 @@ def build_star_embed(message: Message):
 
 class Starboard(Cog, name="Starboard"):
 
-    @Cog.listener()
-    async def on_raw_reaction_add(self, payload: RawReactionActionEvent):
-        if not payload.guild_id:
-            return
-
-        if payload.emoji != PartialEmoji.from_str("⭐"):
-            return
-
-        statement = """
-        SELECT enabled, channel_id, required_stars FROM LevelingSettings
-        WHERE guild_id = %s;
-        """
-        settings = self.bot.database.execute(
-            statement, (payload.guild_id,), 1)
+    def __init__(self, bot: Anomaly):
+        super().__init__(bot)
+        self.stars = StarCounter()
+        self.renders = RenderCache()
+        # source_message_id -> the task that syncs its starboard post
+        self.updates = {}
+        # Messages whose stars changed since their post was last synced
+        self.stale = set()
+        # Guilds with a history backfill running
+        self.backfills = set()
+
+    def cog_unload(self):
+        for update in self.updates.values():
+            update.cancel()
+
+    def cache_stats(self):
+        return {
+            "starboard_stars": self.stars.stats(),
+            "starboard_renders": self.renders.stats()
+        }
+
+    RootGroup = SlashCommandGroup(
+        "sb", "Commands related to Starboard")
+
+    async def get_settings(self, guild_id: int):
+        """The guild's settings and starboard channel, or (None, None) if the starboard is off"""
+        settings = await self.bot.settings.get("StarboardSettings", guild_id)
+
+        if not settings or not settings.enabled or not settings.channel_id:
+            return None, None
+
+        starboardChannel = await self.bot.get_or_fetch_channel(settings.channel_id)
+        if not starboardChannel:
+            return None, None
 
-        if not settings or not settings[0] or not settings[1]:
-            return
+        return settings, starboardChannel
 
-        starboardChannel = self.bot.get_or_fetch_channel(settings[1])
-        if not starboardChannel:
-            return
+    async def fetch_source(self, channel_id: int, message_id: int):
+        sourceChannel = await self.bot.get_or_fetch_channel(channel_id)
+        if not sourceChannel:
+            return None
 
-        sourceChannel = self.bot.get_or_fetch_channel(payload.channel_id)
+        with suppress(HTTPException):
+            return await sourceChannel.fetch_message(message_id)
 
-        try:
-            message = await sourceChannel.fetch_message(payload.message_id)
-        except HTTPException:
-            return
+    async def seed(self, payload: RawReactionActionEvent):
+        """Count a message's stars from one fetch, and look up its starboard post"""
+        message = await self.fetch_source(payload.channel_id, payload.message_id)
+        if not message:
+            return None, None
 
         reaction = get(message.reactions, emoji=PartialEmoji.from_str("⭐"))
 
@@ -80,275 +114,361 @@ class Starboard(Cog, name="Starboard"):
         WHERE guild_id = %s AND source_message_id = %s;
         """
 
-        starboardMessageID = self.bot.database.execute(
-            statement, (payload.guild_id, message.id), 1)
+        starboardMessageID = await self.bot.database.fetchone(
+            statement, (payload.guild_id, message.id))
 
-        starboardMessage = None
-        if starboardMessageID:
-            with suppress(HTTPException):
-                starboardMessage = await starboardChannel.fetch_message(starboardMessageID)
+        entry = self.stars.seed(
+            message.id, count, starboardMessageID[0] if starboardMessageID else None)
+        return entry, message
 
-        # If the starboard message exists, and the stars has dropped below the required amount, delete the message
-        if count < min_stars(settings[2]):
-
-            if starboardMessage:
-                with suppress(HTTPException):
-                    await starboardMessage.delete()
-
-            statement = """
-            DELETE FROM StarboardMessages
-            WHERE source_message_id = %s;
-            """
-
-            self.bot.database.execute(statement, (starboardMessageID,))
+    async def delete_post(self, message_id: int, entry: list, starboardChannel):
+        starboardMessageID = entry[1]
+        if not starboardMessageID:
             return
+        entry[1] = None
 
-        rebuild = False
-        if starboardMessage:
-            if starboardMessage.flags.suppress_embeds:
-                with suppress(HTTPException):
-                    await starboardMessage.delete()
-                rebuild = True
-
-            else:
-                with suppress(HTTPException):
-                    await starboardMessage.edit(content=f"**{count} ⭐**", embed=starboardMessage.embeds[0])
-                return
-
-        if rebuild or count >= settings[2]:
-            embed = build_star_embed(message)
-
-            starboardMessage = None
-
-            view = View()
-            url = message.jump_url.replace("@me", str(payload.guild_id))
-            view.add_item(Button(style=ButtonStyle.link,
-                                 label="Jump to message", url=url, row=0))
-
-            with suppress(HTTPException):
-                starboardMessage = await starboardChannel.send(content=f"⭐ **{count} Stars**", embed=embed, view=view)
-
-            if starboardMessage:
-                statement = """
-                INSERT INTO StarboardMessages(guild_id, source_message_id, starboard_message_id)
-                VALUES (%s, %s, %s)  ON CONFLICT (source_message_id) DO UPDATE
-                    SET starboard_message_id = %s;
-                """
-                self.bot.database.execute(
-                    statement, (payload.guild_id, message.id, starboardMessage.id, starboardMessage.id))
-
-    @Cog.listener()
-    async def on_raw_reaction_remove(self, payload: RawReactionActionEvent):
-
-        if not payload.guild_id:
-            return
-
-        if payload.emoji != PartialEmoji.from_str("⭐"):
-            return
+        with suppress(HTTPException):
+            await starboardChannel.get_partial_message(starboardMessageID).delete()
 
         statement = """
-        SELECT enabled, channel_id, required_stars FROM LevelingSettings
-        WHERE guild_id = %s;
+        DELETE FROM StarboardMessages
+        WHERE source_message_id = %s;
         """
-        settings = self.bot.database.execute(
-            statement, (payload.guild_id,), 1)
 
-        if not settings or not settings[0]:
-            return
-
-        if not settings[1]:
-            return
-
-        starboardChannel = self.bot.get_or_fetch_channel(settings[1])
-        if not starboardChannel:
-            return
+        await self.bot.database.execute(statement, (message_id,))
 
-        sourceChannel = self.bot.get_or_fetch_channel(payload.channel_id)
+    def schedule(self, payload):
+        """Sync a message's starboard post shortly, once for any number of reactions in the meantime"""
+        self.stale.add(payload.message_id)
+        if payload.message_id not in self.updates:
+            self.updates[payload.message_id] = self.bot.loop.create_task(
+                self.update_post(payload))
 
+    async def update_post(self, payload):
+        # Only one sync per message at a time, and another one if it changed while syncing
         try:
-            message = await sourceChannel.fetch_message(payload.message_id)
-        except HTTPException:
+            while payload.message_id in self.stale:
+                await asyncio.sleep(2)
+                self.stale.discard(payload.message_id)
+                try:
+                    await self.sync_post(payload)
+                except:
+                    logger.error(
+                        "Failed to update a starboard post", exc_info=True)
+        finally:
+            del self.updates[payload.message_id]
+
+    async def sync_post(self, payload):
+        """Create, edit or delete a message's starboard post to match its current stars"""
+        settings, starboardChannel = await self.get_settings(payload.guild_id)
+        if not settings:
             return
 
-        reaction = get(message.reactions, emoji=PartialEmoji.from_str("⭐"))
-
-        if reaction:
-            count = reaction.count
-        else:
-            count = 0
-
-        statement = """
-        SELECT starboard_message_id FROM StarboardMessages
-        WHERE guild_id = %s AND source_message_id = %s;
-        """
-
-        starboardMessageID = self.bot.database.execute(
-            statement, (payload.guild_id, message.id), 1)
+        # The source message is only fetched to seed its count, or to build a new post
+        message = None
+        entry = self.stars.get(payload.message_id)
+        if entry is None:
+            entry, message = await self.seed(payload)
+            if entry is None:
+                return
 
-        starboardMessage = None
-        if starboardMessageID:
-            with suppress(HTTPException):
-                starboardMessage = await starboardChannel.fetch_message(starboardMessageID)
+        count = entry[0]
 
         # If the starboard message exists, and the stars has dropped below the required amount, delete the message
-        if count < min_stars(settings[2]):
-
-            if starboardMessage:
-                with suppress(HTTPException):
-                    await starboardMessage.delete()
-
-            statement = """
-            DELETE FROM StarboardMessages
-            WHERE source_message_id = %s;
-            """
-
-            self.bot.database.execute(statement, (starboardMessageID,))
+        if count < min_stars(settings.required_stars):
+            await self.delete_post(payload.message_id, entry, starboardChannel)
             return
 
         rebuild = False
-        if starboardMessage:
-            if starboardMessage.flags.suppress_embeds:
-                with suppress(HTTPException):
-                    await starboardMessage.delete()
-                rebuild = True
-
-            else:
-                with suppress(HTTPException):
-                    await starboardMessage.edit(content=f"**{count} ⭐**", embed=starboardMessage.embeds[0])
+        if entry[1]:
+            starboardMessage = None
+            try:
+                starboardMessage = await starboardChannel.get_partial_message(entry[1]).edit(content=f"**{count} ⭐**")
+            except NotFound:
+                pass
+            except HTTPException:
                 return
 
-        if rebuild or count >= settings[2]:
-            embed = build_star_embed(message)
+            if starboardMessage and not starboardMessage.flags.suppress_embeds:
+                return
 
-            starboardMessage = None
+            if starboardMessage:
+                with suppress(HTTPException):
+                    await starboardMessage.delete()
+            entry[1] = None
+            rebuild = True
 
-            view = View()
-            url = message.jump_url.replace("@me", str(payload.guild_id))
-            view.add_item(Button(style=ButtonStyle.link,
-                                 label="Jump to message", url=url, row=0))
+        if rebuild or count >= settings.required_stars:
+            if message:
+                render = self.render(message)
+            else:
+                render = self.renders.latest(payload.message_id)
+            if not render:
+                message = await self.fetch_source(payload.channel_id, payload.message_id)
+                if not message:
+                    return
+                render = self.render(message)
 
-            with suppress(HTTPException):
-                starboardMessage = await starboardChannel.send(content=f"⭐ **{count} Stars**", embed=embed, view=view)
+            starboardMessage = await self.send_post(render, count, starboardChannel)
 
             if starboardMessage:
+                entry[1] = starboardMessage.id
                 statement = """
                 INSERT INTO StarboardMessages(guild_id, source_message_id, starboard_message_id)
                 VALUES (%s, %s, %s)  ON CONFLICT (source_message_id) DO UPDATE
                     SET starboard_message_id = %s;
                 """
-                self.bot.database.execute(
-                    statement, (payload.guild_id, message.id, starboardMessage.id, starboardMessage.id))
+                await self.bot.database.execute(
+                    statement, (payload.guild_id, payload.message_id, starboardMessage.id, starboardMessage.id))
 
-    @Cog.listener()
-    async def on_raw_reaction_clear(self, payload: RawReactionClearEvent):
+    def render(self, message: Message):
+        """A message's post embed and jump URL, only built again if the message was edited"""
+        render = self.renders.get(message.id, message.edited_at)
+        if render is None:
+            url = message.jump_url.replace("@me", str(message.guild.id))
+            render = self.renders.put(
+                message.id, message.edited_at, (build_star_embed(message), url))
+        return render
 
-        if not payload.guild_id:
-            return
+    async def send_post(self, render: tuple, count: int, starboardChannel):
+        embed, url = render
 
-        statement = """
-        SELECT enabled, channel_id, required_stars FROM LevelingSettings
-        WHERE guild_id = %s;
-        """
-        settings = self.bot.database.execute(
-            statement, (payload.guild_id,), 1)
+        view = View()
+        view.add_item(Button(style=ButtonStyle.link,
+                             label="Jump to message", url=url, row=0))
 
-        if not settings or not settings[0]:
-            return
+        with suppress(HTTPException):
+            return await starboardChannel.send(content=f"⭐ **{count} Stars**", embed=embed, view=view)
 
-        if not settings[1]:
+    async def starred(self, payload: RawReactionActionEvent, change: int):
+        if not payload.guild_id:
             return
 
-        starboardChannel = self.bot.get_or_fetch_channel(settings[1])
-        if not starboardChannel:
+        if payload.emoji != PartialEmoji.from_str("⭐"):
             return
 
-        sourceChannel = self.bot.get_or_fetch_channel(payload.channel_id)
+        settings = await self.bot.settings.get("StarboardSettings", payload.guild_id)
 
-        try:
-            message = await sourceChannel.fetch_message(payload.message_id)
-        except HTTPException:
+        if not settings or not settings.enabled or not settings.channel_id:
             return
 
-        statement = """
-        SELECT starboard_message_id FROM StarboardMessages
-        WHERE guild_id = %s AND source_message_id = %s;
-        """
+        # Unseeded messages are counted by the fetch that seeds them, after the burst
+        self.stars.star(payload.message_id, change)
+        self.schedule(payload)
 
-        starboardMessageID = self.bot.database.execute(
-            statement, (payload.guild_id, message.id), 1)
+    @Cog.listener()
+    async def on_raw_reaction_add(self, payload: RawReactionActionEvent):
+        await self.starred(payload, 1)
 
-        starboardMessage = None
-        if starboardMessageID:
-            with suppress(HTTPException):
-                starboardMessage = await starboardChannel.fetch_message(starboardMessageID)
+    @Cog.listener()
+    async def on_raw_reaction_remove(self, payload: RawReactionActionEvent):
+        await self.starred(payload, -1)
 
-        if starboardMessage:
-            with suppress(HTTPException):
-                await starboardMessage.delete()
+    @Cog.listener()
+    async def on_raw_message_edit(self, payload: RawMessageUpdateEvent):
+        # Embeds unfurling doesn't change the edit time, but can still change the post
+        editedAt = payload.data.get("edited_timestamp")
+        self.renders.edited(payload.message_id,
+                            parse_time(editedAt) if editedAt else None)
 
-        statement = """
-        DELETE FROM StarboardMessages
-        WHERE source_message_id = %s;
-        """
+    async def unstarred(self, payload):
+        if not payload.guild_id:
+            return
+
+        settings = await self.bot.settings.get("StarboardSettings", payload.guild_id)
+
+        if not settings or not settings.enabled or not settings.channel_id:
+            return
 
-        self.bot.database.execute(statement, (starboardMessageID,))
+        # The post is deleted by the sync, so it can't race with one that's in flight
+        self.stars.discard(payload.message_id)
+        self.schedule(payload)
 
     @Cog.listener()
-    async def on_reaction_clear_emoji(self, payload: RawReactionClearEmojiEvent):
+    async def on_raw_reaction_clear(self, payload: RawReactionClearEvent):
+        await self.unstarred(payload)
+
+    @Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, payload: RawReactionClearEmojiEvent):
 
         if payload.emoji != PartialEmoji.from_str("⭐"):
             return
 
-        if not payload.guild_id:
-            return
+        await self.unstarred(payload)
 
-        statement = """
-        SELECT enabled, channel_id, required_stars FROM LevelingSettings
-        WHERE guild_id = %s;
-        """
-        settings = self.bot.database.execute(
-            statement, (payload.guild_id,), 1)
+    @RootGroup.command(name="backfill")
+    @cooldown(1, 300, BucketType.guild)
+    @has_guild_permissions(administrator=True)
+    @guild_only()
+    async def backfill(self, ctx: ApplicationContext, channel: Option(TextChannel, "Channel to scan (every channel if not given)", required=False, default=None), limit: Option(int, "Messages to scan per channel, including earlier scans", min_value=1, max_value=50000, required=False, default=5000), restart: Option(bool, "Start over instead of resuming the last scan", required=False, default=False)):
+        """Add already starred messages to the starboard"""
+
+        await ctx.defer(ephemeral=True)
 
-        if not settings or not settings[0]:
+        settings, starboardChannel = await self.get_settings(ctx.guild.id)
+        if not settings:
+            await ctx.respond("The Starboard module is disabled!", ephemeral=True)
             return
 
-        if not settings[1]:
+        if ctx.guild.id in self.backfills:
+            await ctx.respond("A backfill is already running in this server!", ephemeral=True)
             return
 
-        starboardChannel = self.bot.get_or_fetch_channel(settings[1])
-        if not starboardChannel:
+        if channel:
+            channels = [channel]
+        else:
+            channels = ctx.guild.text_channels
+        channels = [c for c in channels if c != starboardChannel and c.permissions_for(
+            ctx.guild.me).read_message_history]
+
+        if not channels:
+            await ctx.respond("There aren't any channels I can scan!", ephemeral=True)
             return
 
-        sourceChannel = self.bot.get_or_fetch_channel(payload.channel_id)
+        if restart:
+            statement = """
+            DELETE FROM StarboardBackfill
+            WHERE channel_id = ANY(%s);
+            """
+            await self.bot.database.execute(statement, ([c.id for c in channels],))
+
+        self.backfills.add(ctx.guild.id)
+        try:
+            # Scan a few channels at a time, sharing one budget of requests
+            semaphore = asyncio.Semaphore(3)
+            budget = RequestBudget(2)
+            done = 0
+            posted = 0
+            failed = []
+
+            async def scan(channel: TextChannel):
+                nonlocal done, posted
+                # One channel failing shouldn't stop the others, it's picked up again next time
+                try:
+                    async with semaphore:
+                        posted += await self.backfill_channel(channel, settings, starboardChannel, limit, budget)
+                except asyncio.CancelledError:
+                    raise
+                except:
+                    failed.append(channel)
+                    logger.error(
+                        f"Stopped backfilling the starboard from a channel (ID: {channel.id})", exc_info=True)
+                done += 1
+                progressBar = make_progress_bar(done / len(channels))
+                with suppress(HTTPException):
+                    await ctx.edit(content=f"Scanning message history...\n{progressBar} {done}/{len(channels)} channels, {posted} messages added, {len(failed)} failed")
+
+            await asyncio.gather(*(scan(c) for c in channels))
+        finally:
+            self.backfills.discard(ctx.guild.id)
+
+        content = f"Backfill finished! {posted} messages were added to the starboard."
+        if failed:
+            content += f"\nCouldn't finish scanning {', '.join(c.mention for c in failed)}, run the command again to resume."
 
+        # A long backfill can outlive the interaction token
         try:
-            message = await sourceChannel.fetch_message(payload.message_id)
+            await ctx.edit(content=content)
         except HTTPException:
-            return
+            with suppress(HTTPException):
+                await ctx.channel.send(f"{ctx.author.mention} {content}")
+
+    async def backfill_channel(self, channel: TextChannel, settings, starboardChannel, limit: int, budget: RequestBudget):
+        """Scan a channel's history from where the last scan left off, and return how many messages were posted
 
+        `limit` counts every scan of the channel, so a larger limit carries on
+        from an earlier scan that stopped at its limit.
+        """
         statement = """
-        SELECT starboard_message_id FROM StarboardMessages
-        WHERE guild_id = %s AND source_message_id = %s;
+        SELECT before_message_id, scanned, done FROM StarboardBackfill
+        WHERE channel_id = %s;
         """
+        progress = await self.bot.database.fetchone(statement, (channel.id,))
+
+        # Done means the whole history was scanned
+        if progress and progress[2]:
+            return 0
+        before, scanned = (progress[0], progress[1]) if progress else (None, 0)
+        if scanned >= limit:
+            return 0
+
+        posted = 0
+        batch = []
+        requested = limit - scanned
+        fetched = 0
+        await budget.spend()
+        async for message in channel.history(limit=requested, before=Object(before) if before else None):
+            batch.append(message)
+            fetched += 1
+            # One history request per 100 messages
+            if len(batch) == 100:
+                posted += await self.backfill_batch(channel, batch, settings, starboardChannel, budget)
+                scanned += len(batch)
+                await self.save_backfill(channel, batch[-1].id, scanned, False)
+                batch = []
+                await budget.spend()
+
+        posted += await self.backfill_batch(channel, batch, settings, starboardChannel, budget)
+        scanned += len(batch)
+        # Fewer messages than asked for means there aren't any older ones left
+        await self.save_backfill(channel, batch[-1].id if batch else before, scanned, fetched < requested)
+
+        return posted
+
+    async def backfill_batch(self, channel: TextChannel, messages: list, settings, starboardChannel, budget: RequestBudget):
+        starred = []
+        for message in messages:
+            reaction = get(message.reactions,
+                           emoji=PartialEmoji.from_str("⭐"))
+            # Leave messages that are being synced live to the live sync
+            if reaction and reaction.count >= settings.required_stars and message.id not in self.updates:
+                starred.append((message, reaction.count))
+
+        if not starred:
+            return 0
 
-        starboardMessageID = self.bot.database.execute(
-            statement, (payload.guild_id, message.id), 1)
+        statement = """
+        SELECT source_message_id FROM StarboardMessages
+        WHERE source_message_id = ANY(%s);
+        """
+        posted = await self.bot.database.fetchall(statement, ([m.id for m, _ in starred],))
+        posted = {r[0] for r in posted or []}
 
-        starboardMessage = None
-        if starboardMessageID:
-            with suppress(HTTPException):
-                starboardMessage = await starboardChannel.fetch_message(starboardMessageID)
+        columns = ([], [], [])
+        # Oldest first, so the starboard stays in order
+        for message, count in reversed(starred):
+            if message.id in posted:
+                continue
 
-        if starboardMessage:
-            with suppress(HTTPException):
-                await starboardMessage.delete()
+            await budget.spend()
+            starboardMessage = await self.send_post(self.render(message), count, starboardChannel)
+            if starboardMessage:
+                self.stars.seed(message.id, count, starboardMessage.id)
+                columns[0].append(channel.guild.id)
+                columns[1].append(message.id)
+                columns[2].append(starboardMessage.id)
+
+        if columns[0]:
+            statement = """
+            INSERT INTO StarboardMessages(guild_id, source_message_id, starboard_message_id)
+            SELECT * FROM UNNEST(%s::BIGINT[], %s::BIGINT[], %s::BIGINT[])
+            ON CONFLICT (source_message_id) DO UPDATE
+                SET starboard_message_id = EXCLUDED.starboard_message_id;
+            """
+            await self.bot.database.execute(statement, columns)
+
+        return len(columns[0])
 
+    async def save_backfill(self, channel: TextChannel, before: int, scanned: int, done: bool):
         statement = """
-        DELETE FROM StarboardMessages
-        WHERE source_message_id = %s;
+        INSERT INTO StarboardBackfill(guild_id, channel_id, before_message_id, scanned, done)
+        VALUES (%s, %s, %s, %s, %s) ON CONFLICT (channel_id) DO UPDATE
+            SET before_message_id = EXCLUDED.before_message_id,
+            scanned = EXCLUDED.scanned,
+            done = EXCLUDED.done;
         """
-
-        self.bot.database.execute(statement, (starboardMessageID,))
+        await self.bot.database.execute(
+            statement, (channel.guild.id, channel.id, before, scanned, done))
 
 
 def setup(bot):
@@ -54,7 +54,7 @@ class Polls(Cog, name="Polls"):
             SELECT view_custom_id, guild_id, channel_id, message_id, topic, max_choices, option_1, option_2, option_3, option_4, option_5
             FROM Polls;
             """
-            polls = self.bot.database.execute(statement, count=-1) or []
+            polls = await self.bot.database.fetchall(statement) or []
 
             for poll in polls:
                 guild = self.bot.get_guild(poll[1])
@@ -115,7 +115,7 @@ class Polls(Cog, name="Polls"):
         INSERT INTO Polls
         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
         """
-        self.bot.database.execute(
+        await self.bot.database.execute(
             statement, (id, ctx.guild.id, ctx.channel.id, msg.id, max_choices, topic, *options))
 
     @ Cog.listener()
@@ -133,7 +133,7 @@ class Polls(Cog, name="Polls"):
         SELECT * FROM Polls
         WHERE message_id = %s;
         """
-        data = self.bot.database.execute(statement, (message.id,), 1)
+        data = await self.bot.database.fetchone(statement, (message.id,))
 
         if not data:
             return
@@ -143,52 +143,50 @@ class Polls(Cog, name="Polls"):
             DELETE FROM Polls
             WHERE message_id = %s;
             """
-            self.bot.database.execute(statement, (message.id,))
+            await self.bot.database.execute(statement, (message.id,))
 
             await message.delete()
             return
 
-        options = [i for i in data[4:8] if i]
+        options = [i for i in data[6:11] if i]
 
         chosenOptions = interaction.data["values"]
         response = interaction.response
         member = interaction.user
 
-        # update votes
-        statement = """
-        DELETE FROM PollVotes
-        WHERE message_id = %s AND member_id = %s;
-        """
-        self.bot.database.execute(statement, (message.id, member.id))
-
-        statement = """
-        INSERT INTO PollVotes
-        VALUES (%s, %s, %s);
-        """
-
-        for i in chosenOptions:
-            self.bot.database.execute(
-                statement, (message.id, member.id, int(i)))
+        # update votes, all in one round trip
+        async with self.bot.database.transaction() as tx:
+            statement = """
+            DELETE FROM PollVotes
+            WHERE message_id = %s AND member_id = %s;
+            """
+            await tx.execute(statement, (message.id, member.id))
 
-        statement = """
-        SELECT option, COUNT(*) FROM PollVotes
-        WHERE message_id = %s
-        GROUP BY option
-        ORDER BY option ASC;
-        """
+            statement = """
+            INSERT INTO PollVotes
+            VALUES (%s, %s, %s);
+            """
+            await tx.executemany(
+                statement, [(message.id, member.id, int(i)) for i in chosenOptions])
 
-        voteCounts = self.bot.database.execute(
-            statement, (message.id,), count=-1)
+            statement = """
+            SELECT option, COUNT(*) FROM PollVotes
+            WHERE message_id = %s
+            GROUP BY option
+            ORDER BY option ASC;
+            """
+            voteCounts = await tx.execute(statement, (message.id,))
 
-        statement = """
-        SELECT COUNT(*) FROM PollVotes
-        WHERE message_id = %s;
-        """
+            statement = """
+            SELECT COUNT(*) FROM PollVotes
+            WHERE message_id = %s;
+            """
+            totalVotes = await tx.execute(statement, (message.id,))
 
-        totalVotes = self.bot.database.execute(
-            statement, (message.id,), 1) or 0
+        voteCounts = voteCounts.fetchall() or []
+        totalVotes = totalVotes.fetchone()[0]
 
-        embed = Embed(title=data[3], color=Colors.lavender())
+        embed = Embed(title=data[4], color=Colors.lavender())
 
         for i in voteCounts:
             if not totalVotes:
@@ -196,7 +194,7 @@ class Polls(Cog, name="Polls"):
             else:
                 percentage = round(100 * i[1] / totalVotes, 1)
             embed.add_field(
-                name=options[i[0]], value=f"{i[1]} Votes ({percentage}%)", inline=False)
+                name=options[i[0]-1], value=f"{i[1]} Votes ({percentage}%)", inline=False)
 
         embed.set_footer(text=f"{totalVotes} Total Votes")
         await message.edit(embed=embed)
@@ -17,13 +17,17 @@ class Remind(Cog, name="Remind"):
 
     def __init__(self, bot: Anomaly):
         super().__init__(bot)
+        self.bot.loop.create_task(self.load_reminders())
+
+    async def load_reminders(self):
+        await self.bot.wait_until_ready()
         loop = self.bot.loop
 
         statement = """
         SELECT reminder_id, user_id, reminder, expires
         FROM Reminders;
         """
-        reminders = self.bot.database.execute(statement, count=-1) or []
+        reminders = await self.bot.database.fetchall(statement) or []
 
         for r in reminders:
             if r[3] > utcnow():
@@ -50,7 +54,7 @@ class Remind(Cog, name="Remind"):
         DELETE FROM Reminders
         WHERE reminder_id = %s;
         """
-        self.bot.database.execute(statement, (reminder_id,))
+        await self.bot.database.execute(statement, (reminder_id,))
 
     RootGroup = SlashCommandGroup(
         "remind", "Commands related to the Remind module")
@@ -75,8 +79,8 @@ class Remind(Cog, name="Remind"):
         RETURNING reminder_id;
         """
 
-        reminder_id = self.bot.database.execute(
-            statement, (ctx.author.id, message, remindAt), 1)
+        reminder_id = await self.bot.database.fetchone(
+            statement, (ctx.author.id, message, remindAt))
 
         embed = Embed(title="Reminder Created!", color=Colors.hot_pink())
         embed.description = message
@@ -22,18 +22,14 @@ class TempVC(Cog, name="Temp VC"):
         if member.bot:
             return
 
-        statement = """
-        SELECT enabled, channel_id FROM TempVCSettings WHERE guild_id = %s;
-        """
-        settings = self.bot.database.execute(
-            statement, (guild.id,), 1)
+        settings = await self.bot.settings.get("TempVCSettings", guild.id)
 
-        if not settings or not settings[0]:
+        if not settings or not settings.enabled:
             return
 
         # if the user is joining the temp vc channel
         after = after.channel
-        if after and after.id == settings[1]:
+        if after and after.id == settings.channel_id:
             # make sure we can move them
             afterCategory = after.category
             perms = afterCategory.permissions_for(guild.me)
@@ -47,7 +43,7 @@ class TempVC(Cog, name="Temp VC"):
                     VALUES (%s, %s);
                     """
 
-                self.bot.database.execute(statement, (guild.id, newVC.id))
+                await self.bot.database.execute(statement, (guild.id, newVC.id))
 
         # if the user is leaving the temp vc channel, and the channel is now empty
         before = before.channel
@@ -60,8 +56,8 @@ class TempVC(Cog, name="Temp VC"):
                 WHERE guild_id = %s AND channel_id = %s;
                 """
 
-                maybeExists = self.bot.database.execute(
-                    statement, (guild.id, before.id), 1)
+                maybeExists = await self.bot.database.fetchone(
+                    statement, (guild.id, before.id))
 
                 if maybeExists:
                     try:
@@ -73,7 +69,7 @@ class TempVC(Cog, name="Temp VC"):
                         DELETE FROM TempVCChannels
                         WHERE channel_id = %s;
                         """
-                        self.bot.database.execute(statement, (before.id,))
+                        await self.bot.database.execute(statement, (before.id,))
 
     def cog_unload(self):
         self.manual_remove.cancel()
@@ -87,7 +83,7 @@ class TempVC(Cog, name="Temp VC"):
         statement = """
         SELECT channel_id FROM TempVCChannels
         """
-        channels = self.bot.database.execute(statement, count=-1) or []
+        channels = await self.bot.database.fetchall(statement) or []
 
         for channel in channels:
             c = await self.bot.get_or_fetch_channel(channel[0])
@@ -96,7 +92,7 @@ class TempVC(Cog, name="Temp VC"):
                 DELETE FROM TempVCChannels
                 WHERE channel_id = %s;
                 """
-                self.bot.database.execute(statement)
+                await self.bot.database.execute(statement)
 
             elif not len([m for m in c.members if not m.bot]):
                 try:
@@ -108,7 +104,7 @@ class TempVC(Cog, name="Temp VC"):
                         DELETE FROM TempVCChannels
                         WHERE channel_id = %s;
                         """
-                    self.bot.database.execute(statement, (c.id,))
+                    await self.bot.database.execute(statement, (c.id,))
 
     @manual_remove.before_loop
     async def before_manual_remove(self):
@@ -4,10 +4,12 @@ from contextlib import suppress
 
 from discord import (AllowedMentions, Bot, Guild, HTTPException, Intents,
                      PartialEmoji)
+from discord.ext.tasks import loop
 from discord.utils import utcnow
 from emoji import UNICODE_EMOJI
 
 from tools.database import Database
+from tools.settings import SettingsCache
 
 logger = logging.getLogger("kosmo")
 
@@ -43,8 +45,37 @@ class Anomaly(Bot):
         )
 
         self.database = Database()
+        self.settings = SettingsCache(self.database)
 
         self.connected = False
+        self.log_stats.start()
+
+    async def start(self, *args, **kwargs):
+        await self.database.connect()
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        await super().close()
+        self.log_stats.cancel()
+        if self.settings.listener:
+            self.settings.listener.cancel()
+        await self.database.close()
+
+    @loop(hours=1)
+    async def log_stats(self):
+        """Log the size and hit rate of every in-process cache
+
+        Cogs with caches of their own add them with a `cache_stats()` method.
+        """
+        stats = {"settings": self.settings.stats()}
+        for cog in self.cogs.values():
+            if hasattr(cog, "cache_stats"):
+                stats.update(cog.cache_stats())
+        logger.info(f"Cache stats: {stats}")
+
+    @log_stats.before_loop
+    async def before_log_stats(self):
+        await self.wait_until_ready()
 
     def process_reconnect(self):
         self.connected = True
@@ -60,6 +91,8 @@ class Anomaly(Bot):
             logger.info(
                 f"{self.user} has logged into Discord (Running on {len(self.guilds)} servers)")
 
+        await self.settings.load()
+
         if not self.connected:
             self.process_reconnect()
 
@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from time import time
+
+
+class CooldownMap():
+    """Per-key rate window (e.g. per guild member) that forgets keys once their window has passed
+
+    Keys are kept in the order they were last triggered, so expired keys are
+    always at the front and are swept off as new triggers come in.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self.entries = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sweep(self, now: float = None):
+        """Drop every key whose window has passed"""
+        now = time() if now is None else now
+        cutoff = now - self.window
+
+        entries = self.entries
+        while entries:
+            key, last = next(iter(entries.items()))
+            if last > cutoff:
+                break
+            del entries[key]
+            self.evictions += 1
+
+    def trigger(self, key, now: float = None):
+        """Start a new window for a key and return True, or return False if it's still in one"""
+        now = time() if now is None else now
+        self.sweep(now)
+
+        last = self.entries.get(key)
+        if last is not None and now - last < self.window:
+            return False
+
+        self.entries[key] = now
+        self.entries.move_to_end(key)
+        return True
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "evictions": self.evictions
+        }
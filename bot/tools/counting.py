@@ -0,0 +1,261 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import suppress
+
+from discord import Embed, HTTPException, Message
+
+from tools.database import Database
+
+logger = logging.getLogger("kosmo")
+
+statements = {
+    "counting.state": """
+    SELECT next_number, highscore, last_counted_member_id, last_counted_message_id FROM CountingData
+    WHERE guild_id = %s;
+    """,
+    "counting.last_messages": """
+    SELECT guild_id, last_counted_message_id FROM CountingData
+    WHERE last_counted_message_id IS NOT NULL;
+    """,
+    # Guilds whose Counting settings were deleted are dropped instead of failing the whole batch
+    "counting.flush": """
+    INSERT INTO CountingData(guild_id, next_number, highscore, last_counted_member_id, last_counted_message_id)
+    SELECT u.guild_id, u.next_number, u.highscore, u.last_counted_member_id, u.last_counted_message_id
+    FROM UNNEST(%s::BIGINT[], %s::INT[], %s::INT[], %s::BIGINT[], %s::BIGINT[])
+        AS u(guild_id, next_number, highscore, last_counted_member_id, last_counted_message_id)
+    WHERE EXISTS (
+        SELECT 1 FROM CountingSettings s
+        WHERE s.guild_id = u.guild_id
+    )
+    ON CONFLICT (guild_id) DO UPDATE
+        SET next_number = EXCLUDED.next_number,
+        highscore = EXCLUDED.highscore,
+        last_counted_member_id = EXCLUDED.last_counted_member_id,
+        last_counted_message_id = EXCLUDED.last_counted_message_id;
+    """
+}
+
+
+class CountingState():
+    """A guild's count"""
+
+    def __init__(self, next_number: int = 1, highscore: int = 0, last_member_id: int = None, last_message_id: int = None):
+        self.next_number = next_number
+        self.highscore = highscore
+        self.last_member_id = last_member_id
+        self.last_message_id = last_message_id
+
+    def count(self, member_id: int, message_id: int):
+        self.next_number += 1
+        self.last_member_id = member_id
+        self.last_message_id = message_id
+
+    def reset(self):
+        self.highscore = max(self.next_number - 1, self.highscore)
+        self.next_number = 1
+        self.last_member_id = None
+        self.last_message_id = None
+
+
+class CountingEngine():
+    """Authoritative, in-memory counting state
+
+    Each guild's state is read from the database once and then only changed
+    here. Messages for a channel are handled one at a time, in the order they
+    arrived, by that channel's consumer task. Changed states are written back
+    shortly after, with any changes in the meantime coalesced into one write.
+    """
+
+    def __init__(self, database: Database, handler, delay: float = 1.0):
+        self.database = database
+        self.database.register(statements)
+        # Awaited with each message, one at a time per channel
+        self.handler = handler
+        self.delay = delay
+
+        self.states = {}
+        # guild_id -> last counted message ID, for every guild, loaded or not
+        self.last_messages = {}
+        self.indexed = False
+
+        self.queues = {}
+        self.consumers = {}
+
+        self.dirty = set()
+        self.writer = None
+
+    async def state(self, guild_id: int):
+        state = self.states.get(guild_id)
+        if state is None:
+            data = await self.database.fetchone("counting.state", (guild_id,))
+            # Another task may have loaded it while we were waiting
+            state = self.states.setdefault(
+                guild_id, CountingState(*data) if data else CountingState())
+            self.last_messages[guild_id] = state.last_message_id
+        return state
+
+    async def index(self):
+        """Load every guild's last counted message ID in bulk"""
+        rows = await self.database.fetchall("counting.last_messages") or []
+        for guild_id, message_id in rows:
+            # States loaded in the meantime are newer
+            if guild_id not in self.states:
+                self.last_messages[guild_id] = message_id
+        self.indexed = True
+
+    def counted_last(self, guild_id: int, message_ids: set):
+        """Whether any of the messages might be a guild's last counted message, without any database call"""
+        if not self.indexed:
+            # Can't rule it out until the index is loaded
+            return True
+        return self.last_messages.get(guild_id) in message_ids
+
+    def submit(self, channel_id: int, message):
+        """Queue a message for its channel's consumer"""
+        queue = self.queues.get(channel_id)
+        if queue is None:
+            queue = self.queues[channel_id] = asyncio.Queue()
+            self.consumers[channel_id] = asyncio.create_task(
+                self.consume(queue))
+        queue.put_nowait(message)
+
+    async def consume(self, queue: asyncio.Queue):
+        while True:
+            message = await queue.get()
+            try:
+                await self.handler(message)
+            except asyncio.CancelledError:
+                raise
+            except:
+                logger.error("Failed to handle a counting message", exc_info=True)
+
+    def changed(self, guild_id: int):
+        """Mark a guild's state to be written to the database"""
+        state = self.states.get(guild_id)
+        # Forgotten while it was being changed
+        if state is None:
+            return
+        self.dirty.add(guild_id)
+        self.last_messages[guild_id] = state.last_message_id
+        if not self.writer or self.writer.done():
+            self.writer = asyncio.create_task(self.write_later())
+
+    def forget(self, guild_id: int):
+        """Drop a guild's state, along with any changes that haven't been written yet"""
+        self.states.pop(guild_id, None)
+        self.last_messages.pop(guild_id, None)
+        self.dirty.discard(guild_id)
+
+    async def write_later(self):
+        # Keep going while states change during a write, but give up on errors until the next change
+        while self.dirty:
+            await asyncio.sleep(self.delay)
+            if not await self.flush():
+                return
+
+    async def flush(self):
+        """Write every changed state in one statement"""
+        if not self.dirty:
+            return True
+
+        # Guilds forgotten after a failed write have nothing left to write
+        flushing = {g for g in self.dirty if g in self.states}
+        self.dirty = set()
+        if not flushing:
+            return True
+
+        columns = ([], [], [], [], [])
+        for guild_id in flushing:
+            state = self.states[guild_id]
+            columns[0].append(guild_id)
+            columns[1].append(state.next_number)
+            columns[2].append(state.highscore)
+            columns[3].append(state.last_member_id)
+            columns[4].append(state.last_message_id)
+
+        try:
+            await self.database.execute("counting.flush", columns)
+        except:
+            self.dirty |= flushing
+            logger.error(
+                f"Failed to write {len(flushing)} counting states", exc_info=True)
+            return False
+        return True
+
+    def close(self):
+        for consumer in self.consumers.values():
+            consumer.cancel()
+        if self.writer:
+            self.writer.cancel()
+
+
+class FeedbackDispatcher():
+    """Reactions and messages sent in reply to counts, queued per channel
+
+    Each channel's feedback is sent by its own task, one request at a time and
+    no faster than one every `interval` seconds, which keeps it under the
+    channel's reaction rate limit instead of running into it. Counting never
+    waits on it. A plain ✅ is skipped if another one for the same channel is
+    already queued behind it, since the newer count supersedes it.
+    """
+
+    def __init__(self, interval: float = 0.25):
+        self.interval = interval
+
+        # channel_id -> deque of (message, reactions, embed, skippable)
+        self.queues = {}
+        # channel_id -> number of skippable items in its queue
+        self.skippable = {}
+        self.senders = {}
+
+        self.sent = 0
+        self.skipped = 0
+
+    def submit(self, message: Message, reactions: list, embed: Embed = None, skippable: bool = False):
+        channel_id = message.channel.id
+        self.queues.setdefault(channel_id, deque()).append(
+            (message, reactions, embed, skippable))
+        if skippable:
+            self.skippable[channel_id] = self.skippable.get(channel_id, 0) + 1
+
+        sender = self.senders.get(channel_id)
+        if not sender or sender.done():
+            self.senders[channel_id] = asyncio.create_task(
+                self.send(channel_id))
+
+    async def send(self, channel_id: int):
+        queue = self.queues[channel_id]
+        while queue:
+            message, reactions, embed, skippable = queue.popleft()
+            if skippable:
+                self.skippable[channel_id] -= 1
+                # Only a newer ✅ makes this one redundant, not a ❌ or a special number
+                if self.skippable[channel_id]:
+                    self.skipped += 1
+                    continue
+
+            for reaction in reactions:
+                with suppress(HTTPException):
+                    await message.add_reaction(reaction)
+                await asyncio.sleep(self.interval)
+            if embed:
+                with suppress(HTTPException):
+                    await message.channel.send(embed=embed)
+                await asyncio.sleep(self.interval)
+            self.sent += 1
+
+        del self.queues[channel_id]
+        del self.senders[channel_id]
+        self.skippable.pop(channel_id, None)
+
+    def stats(self):
+        return {
+            "queued": sum(len(q) for q in self.queues.values()),
+            "sent": self.sent,
+            "skipped": self.skipped
+        }
+
+    def close(self):
+        for sender in self.senders.values():
+            sender.cancel()
@@ -1,62 +1,228 @@
-from os import getenv
 import logging
 import sys
+from contextlib import asynccontextmanager, nullcontext
+from os import getenv
 
 import psycopg
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 
 logger = logging.getLogger("kosmo")
 
 
-class Database():
+class Result():
+    """Rows returned by a statement queued in a Transaction"""
+
     def __init__(self):
+        self.rows = []
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows or None
+
+
+class Transaction():
+    """Statements queued inside Database.transaction()
+
+    Statements are sent without waiting for each other's results (when
+    libpq supports pipeline mode), so their results are only available once
+    the transaction block has ended.
+    """
+
+    def __init__(self, conn: psycopg.AsyncConnection, statements: dict):
+        self.conn = conn
+        self.statements = statements
+        self.queued = []
+
+    async def execute(self, statement: str, parameters: tuple = None):
+        """Queue a statement (or the name of a registered one)"""
+        query = self.statements.get(statement, statement)
+        prepare = True if statement in self.statements else None
+
+        cur = self.conn.cursor()
+        await cur.execute(query, parameters, prepare=prepare)
+
+        result = Result()
+        self.queued.append((cur, result))
+        return result
+
+    async def executemany(self, statement: str, parameters: list):
+        """Queue a statement once for every set of parameters"""
+        query = self.statements.get(statement, statement)
+
+        async with self.conn.cursor() as cur:
+            await cur.executemany(query, parameters)
+
+
+class Database():
+    def __init__(self, min_size: int = None, max_size: int = None, timeout: float = None):
 
         self.initialized = False
 
+        self.min_size = min_size or int(getenv("POSTGRES_POOL_MIN_SIZE") or 2)
+        self.max_size = max_size or int(getenv("POSTGRES_POOL_MAX_SIZE") or 10)
+        self.timeout = timeout or float(getenv("POSTGRES_POOL_TIMEOUT") or 10.0)
+
+        # Named statements declared by the cogs, see register()
+        self.statements = {}
+
+        # Number of times the bot has waited on the database for results
+        self.round_trips = 0
+
+        self.conninfo = psycopg.conninfo.make_conninfo(
+            host=getenv("POSTGRES_DB_HOST"),
+            port=getenv("POSTGRES_DB_PORT"),
+            dbname=getenv("POSTGRES_DB_NAME"),
+            user=getenv("POSTGRES_DB_USERNAME"),
+            password=getenv("POSTGRES_DB_PASSWORD")
+        )
+
+        # The pool is opened in connect(), once there is an event loop to open it on
+        self.pool = AsyncConnectionPool(
+            self.conninfo,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            timeout=self.timeout,
+            open=False
+        )
+
+    async def connect(self):
+        """Open the connection pool"""
+        if self.initialized:
+            return
+
         try:
-            self.conn = psycopg2.connect(
-                host=getenv("POSTGRES_DB_HOST"),
-                port=getenv("POSTGRES_DB_PORT"),
-                database=getenv("POSTGRES_DB_NAME"),
-                user=getenv("POSTGRES_DB_USERNAME"),
-                password=getenv("POSTGRES_DB_PASSWORD")
-            )
+            await self.pool.open(wait=True, timeout=self.timeout)
 
             statement = """
             SELECT version();
             """
 
-            db_version = self.execute(statement, count=1)
+            db_version = await self.fetchone(statement)
 
             logger.info(
-                f"Connected to the PostgreSQL database\nversion {' - '.join(db_version)}")
+                f"Connected to the PostgreSQL database (pool size {self.min_size}-{self.max_size})\nversion {' - '.join(db_version)}")
 
             self.initialized = True
 
-        except (Exception, psycopg2.DatabaseError) as error:
+        except (Exception, psycopg.DatabaseError) as error:
             logger.critical(
                 f"Failed to connect to PostgreSQL database:\n{error}")
             sys.exit("Failed to connect to PostgreSQL database")
 
-    def execute(self, statement: str, parameters: tuple = None, count: int = None):
-        cur = self.conn.cursor()
+    async def close(self):
+        """Close the connection pool"""
+        await self.pool.close()
+        self.initialized = False
+
+    def register(self, statements: dict):
+        """Declare named statements that cogs can run by name
+
+        Named statements are prepared server-side on each pooled connection the
+        first time that connection runs them, so Postgres only parses and plans
+        them once per connection.
+        """
+        for name, statement in statements.items():
+            if self.statements.get(name, statement) != statement:
+                raise ValueError(
+                    f'A different statement is already registered as "{name}"')
+            self.statements[name] = statement
+
+    @asynccontextmanager
+    async def connection(self, timeout: float = None):
+        """Borrow a connection from the pool, waiting at most `timeout` seconds for one"""
         try:
-            cur.execute(statement, parameters)
-            self.conn.commit()
-        except:
-            cur.close()
-            self.conn.rollback()
+            async with self.pool.connection(timeout=timeout or self.timeout) as conn:
+                yield conn
+        except PoolTimeout:
             logger.error(
-                f'Failed to execute statement "{statement}" using parameters "{parameters}"', exc_info=True)
+                f"Timed out waiting for a database connection (pool stats: {self.pool.get_stats()})")
             raise
-        else:
-            if count and cur.rowcount >= 1:
-                if count == 1:
-                    results = cur.fetchone()
-                elif count == -1:
-                    results = cur.fetchall()
-                else:
-                    results = cur.fetchmany(count)
-            else:
-                results = None
-            cur.close()
-            return results
+
+    async def _run(self, statement: str, parameters: tuple = None, count: int = None, timeout: float = None):
+        # Registered statements are looked up by name and always prepared
+        query = self.statements.get(statement, statement)
+        prepare = True if statement in self.statements else None
+
+        async with self.connection(timeout) as conn:
+            self.round_trips += 1
+            try:
+                async with conn.cursor() as cur:
+                    await cur.execute(query, parameters, prepare=prepare)
+                    if count and cur.description is not None and cur.rowcount != 0:
+                        if count == 1:
+                            results = await cur.fetchone()
+                        elif count == -1:
+                            results = await cur.fetchall()
+                        else:
+                            results = await cur.fetchmany(count)
+                    else:
+                        results = None
+                    await conn.commit()
+                    return results
+            except:
+                logger.error(
+                    f'Failed to execute statement "{statement}" using parameters "{parameters}"', exc_info=True)
+                raise
+
+    @asynccontextmanager
+    async def transaction(self, timeout: float = None):
+        """Run several statements as one transaction, pipelined into a single round trip
+
+        Without pipeline mode (libpq older than 14) the statements still run as
+        one transaction, just with a round trip each.
+
+        ```
+        async with database.transaction() as tx:
+            await tx.execute("DELETE ...", (...))
+            counts = await tx.execute("SELECT ...", (...))
+        rows = counts.fetchall()
+        ```
+        """
+        pipelined = psycopg.Pipeline.is_supported()
+
+        async with self.connection(timeout) as conn:
+            tx = Transaction(conn, self.statements)
+            try:
+                async with conn.pipeline() if pipelined else nullcontext():
+                    async with conn.transaction():
+                        yield tx
+
+                self.round_trips += 1 if pipelined else len(tx.queued) + 2
+
+                for cur, result in tx.queued:
+                    if cur.description is not None:
+                        result.rows = await cur.fetchall()
+                    await cur.close()
+            except:
+                logger.error(
+                    "Failed to execute transaction", exc_info=True)
+                raise
+
+    async def listen(self, channel: str, on_listen=None):
+        """Yield the payload of every NOTIFY sent on `channel`
+
+        Uses its own connection outside the pool, since a listening connection
+        can't be handed out for queries. `on_listen` is awaited once the
+        connection is listening.
+        """
+        conn = await psycopg.AsyncConnection.connect(self.conninfo, autocommit=True)
+        async with conn:
+            await conn.execute(f"LISTEN {channel};")
+            if on_listen:
+                await on_listen()
+            async for notify in conn.notifies():
+                yield notify.payload
+
+    async def execute(self, statement: str, parameters: tuple = None, timeout: float = None):
+        """Run a statement (or the name of a registered one) without fetching any results"""
+        await self._run(statement, parameters, timeout=timeout)
+
+    async def fetchone(self, statement: str, parameters: tuple = None, timeout: float = None):
+        """Run a statement and return the first row, or None"""
+        return await self._run(statement, parameters, 1, timeout)
+
+    async def fetchall(self, statement: str, parameters: tuple = None, timeout: float = None):
+        """Run a statement and return every row, or None if there were none"""
+        return await self._run(statement, parameters, -1, timeout)
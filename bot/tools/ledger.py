@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import os
+from time import time
+
+import numpy as np
+
+from tools.database import Database
+
+logger = logging.getLogger("kosmo")
+
+statements = {
+    "ledger.member": """
+    SELECT experience, level FROM MemberExperience
+    WHERE guild_id = %s AND member_id = %s;
+    """,
+    "ledger.reset": """
+    DELETE FROM MemberExperience
+    WHERE guild_id = %s AND member_id = %s;
+    """,
+    # Members of guilds whose Leveling settings were deleted are dropped instead of failing the whole batch
+    "ledger.flush": """
+    INSERT INTO MemberExperience(guild_id, member_id, experience, level)
+    SELECT u.guild_id, u.member_id, u.experience, u.level
+    FROM UNNEST(%s::BIGINT[], %s::BIGINT[], %s::INT[], %s::SMALLINT[]) AS u(guild_id, member_id, experience, level)
+    WHERE EXISTS (
+        SELECT 1 FROM LevelingSettings s
+        WHERE s.guild_id = u.guild_id
+    )
+    ON CONFLICT (guild_id, member_id) DO UPDATE
+        SET experience = EXCLUDED.experience,
+        level = EXCLUDED.level;
+    """
+}
+
+
+class ExperienceLedger():
+    """Write-behind store of member experience
+
+    XP is gained in memory and written to the database in batches by flush().
+    Every change is also appended to a local journal, which is replayed on
+    startup so a crash between flushes doesn't lose any XP.
+    """
+
+    def __init__(self, database: Database, get_level, on_change=None, journal: str = "./data/xp_journal", max_dirty: int = 500, idle: float = 600):
+        self.database = database
+        self.database.register(statements)
+        self.get_level = get_level
+        # Called with (guild_id, member_id, experience, level) whenever a member's XP changes
+        self.on_change = on_change
+
+        self.max_dirty = max_dirty
+        self.idle = idle
+
+        # (guild_id, member_id) -> [experience, level, last touched]
+        self.members = {}
+        self.dirty = set()
+
+        self.lock = asyncio.Lock()
+
+        self.journal_path = journal
+        os.makedirs(os.path.dirname(journal), exist_ok=True)
+        self.replay()
+        self.journal = open(self.journal_path, "a")
+
+    def replay(self):
+        """Load any changes that were journaled but never flushed"""
+        replayed = 0
+        # A journal left mid-flush is older than the current one
+        for path in (f"{self.journal_path}.flushing", self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        guild_id, member_id, experience, level = map(
+                            int, line.split())
+                    except ValueError:
+                        # The last line may have been cut off by the crash
+                        continue
+                    self.members[(guild_id, member_id)] = [
+                        experience, level, time()]
+                    self.dirty.add((guild_id, member_id))
+                    replayed += 1
+
+        if replayed:
+            logger.warning(
+                f"Replayed {replayed} unflushed experience changes from the journal")
+
+    def record(self, key: tuple, experience: int, level: int):
+        self.members[key] = [experience, level, time()]
+        self.dirty.add(key)
+        self.journal.write(f"{key[0]} {key[1]} {experience} {level}\n")
+        self.journal.flush()
+
+        if self.on_change:
+            self.on_change(key[0], key[1], experience, level)
+
+        if len(self.dirty) >= self.max_dirty and not self.lock.locked():
+            asyncio.create_task(self.flush())
+
+    async def get(self, guild_id: int, member_id: int):
+        """Get a member's (experience, level)"""
+        key = (guild_id, member_id)
+        entry = self.members.get(key)
+        if entry is None:
+            data = await self.database.fetchone("ledger.member", key) or (0, 0)
+            # Another message may have loaded it while we were waiting
+            entry = self.members.setdefault(key, [data[0], data[1], time()])
+        entry[2] = time()
+        return entry[0], entry[1]
+
+    async def add(self, guild_id: int, member_id: int, gain: int):
+        """Give a member XP and return their (old level, new level, new experience)"""
+        experience, level = await self.get(guild_id, member_id)
+
+        newXP = experience + gain
+        newLevel = self.get_level(newXP)
+        self.record((guild_id, member_id), newXP, newLevel)
+
+        return level, newLevel, newXP
+
+    def set(self, guild_id: int, member_id: int, experience: int, level: int):
+        self.record((guild_id, member_id), experience, level)
+
+    async def reset(self, guild_id: int, member_id: int):
+        """Delete a member's experience"""
+        # Hold the lock so a flush that's in progress can't write them back
+        async with self.lock:
+            key = (guild_id, member_id)
+            old = self.members.get(key)
+            wasDirty = key in self.dirty
+
+            # Leave a zeroed entry, so get() can't load the old row back while the DELETE runs
+            self.members[key] = [0, 0, time()]
+            self.dirty.discard(key)
+            try:
+                await self.database.execute("ledger.reset", key)
+            except:
+                # Nothing was deleted, so put the old entry back unless they've gained XP since
+                if key not in self.dirty:
+                    if old is None:
+                        self.members.pop(key, None)
+                    else:
+                        self.members[key] = old
+                        if wasDirty:
+                            self.dirty.add(key)
+                raise
+            # Journaled so a replay can't bring back XP from before the reset
+            self.journal.write(f"{guild_id} {member_id} 0 0\n")
+            self.journal.flush()
+
+    async def flush(self):
+        """Write every dirty member to the database in one statement"""
+        async with self.lock:
+            if not self.dirty:
+                self.evict()
+                return
+
+            # Start a new journal, the old one is only needed until this flush commits
+            self.journal.close()
+            os.replace(self.journal_path, f"{self.journal_path}.flushing")
+            self.journal = open(self.journal_path, "a")
+
+            flushing = self.dirty
+            self.dirty = set()
+
+            columns = ([], [], [], [])
+            for key in flushing:
+                entry = self.members.get(key)
+                if entry is None:
+                    continue
+                columns[0].append(key[0])
+                columns[1].append(key[1])
+                columns[2].append(entry[0])
+                columns[3].append(entry[1])
+
+            try:
+                await self.database.execute("ledger.flush", columns)
+            except:
+                # Keep them dirty and journaled for the next flush
+                self.dirty |= flushing
+                with open(f"{self.journal_path}.flushing") as old, open(self.journal_path) as new:
+                    lines = old.read() + new.read()
+                self.journal.close()
+                with open(self.journal_path, "w") as journal:
+                    journal.write(lines)
+                self.journal = open(self.journal_path, "a")
+                logger.error(
+                    f"Failed to flush {len(flushing)} experience changes", exc_info=True)
+            finally:
+                os.remove(f"{self.journal_path}.flushing")
+
+            self.evict()
+
+    def evict(self):
+        """Forget clean members that haven't been seen in a while"""
+        cutoff = time() - self.idle
+        for key in [k for k, v in self.members.items() if v[2] < cutoff and k not in self.dirty]:
+            del self.members[key]
+
+    def forget(self, guild_id: int = None):
+        """Forget every clean member of a guild (or of every guild), so they're read from the database again"""
+        for key in [k for k in self.members if k not in self.dirty and guild_id in (None, k[0])]:
+            del self.members[key]
+
+    async def recompute(self, get_levels, guild_id: int = None, batch: int = 50000, progress=None):
+        """Recompute the stored level of every member of a guild (or of every guild) from their experience
+
+        Rows are streamed with a server-side cursor and their levels worked out
+        a batch at a time, then the changed ones are COPY'd into a staging
+        table and written back with a single UPDATE. `progress` is awaited with
+        (rows done, total rows) after every batch. Returns how many levels changed.
+        """
+        where = "WHERE guild_id = %s" if guild_id is not None else ""
+        parameters = (guild_id,) if guild_id is not None else None
+
+        # Anything still in memory has to be in the table first
+        await self.flush()
+
+        changed = 0
+        async with self.lock:
+            async with self.database.connection() as conn:
+                async with conn.transaction():
+                    total = await conn.execute(
+                        f"SELECT COUNT(*) FROM MemberExperience {where};", parameters)
+                    total = (await total.fetchone())[0]
+
+                    await conn.execute("""
+                    CREATE TEMP TABLE LevelRecompute (
+                        guild_id BIGINT NOT NULL,
+                        member_id BIGINT NOT NULL,
+                        level SMALLINT NOT NULL
+                    ) ON COMMIT DROP;
+                    """)
+
+                    done = 0
+                    async with conn.cursor(name="level_recompute") as stream:
+                        await stream.execute(
+                            f"SELECT guild_id, member_id, experience, level FROM MemberExperience {where};", parameters)
+
+                        while rows := await stream.fetchmany(batch):
+                            rows = np.array(rows, dtype=np.int64)
+                            levels = get_levels(rows[:, 2])
+                            stale = levels != rows[:, 3]
+
+                            updates = np.column_stack(
+                                (rows[stale, 0], rows[stale, 1], levels[stale]))
+                            async with conn.cursor() as cur:
+                                async with cur.copy("COPY LevelRecompute (guild_id, member_id, level) FROM STDIN") as copy:
+                                    for row in updates.tolist():
+                                        await copy.write_row(row)
+
+                            changed += len(updates)
+                            done += len(rows)
+                            if progress:
+                                await progress(done, total)
+
+                    await conn.execute("""
+                    UPDATE MemberExperience m
+                        SET level = r.level
+                    FROM LevelRecompute r
+                    WHERE m.guild_id = r.guild_id AND m.member_id = r.member_id;
+                    """)
+
+            self.forget(guild_id)
+
+        return changed
+
+    def close(self):
+        self.journal.close()
@@ -0,0 +1,127 @@
+import asyncio
+
+from discord import Guild
+from sortedcontainers import SortedList
+
+from tools.database import Database
+
+statements = {
+    "ranks.guild": """
+    SELECT member_id, experience, level FROM MemberExperience
+    WHERE guild_id = %s;
+    """
+}
+
+
+class GuildRanks():
+    """One guild's members, sorted by level, then experience, then member ID"""
+
+    def __init__(self):
+        self.sorted = SortedList()
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.sorted)
+
+    def update(self, member_id: int, experience: int, level: int):
+        old = self.keys.get(member_id)
+        if old is not None:
+            self.sorted.remove(old)
+
+        key = (-level, -experience, member_id)
+        self.keys[member_id] = key
+        self.sorted.add(key)
+
+    def remove(self, member_id: int):
+        old = self.keys.pop(member_id, None)
+        if old is not None:
+            self.sorted.remove(old)
+
+    def rank(self, member_id: int):
+        """A member's 1-based position, or None if they aren't ranked"""
+        key = self.keys.get(member_id)
+        if key is None:
+            return None
+        return self.sorted.index(key) + 1
+
+    def page(self, start: int, stop: int):
+        """(member_id, experience, level) for positions start+1 to stop"""
+        return [(k[2], -k[1], -k[0]) for k in self.sorted.islice(start, stop)]
+
+
+class RankIndex():
+    """In-memory leaderboards, kept up to date on every XP change
+
+    A guild is loaded from the database the first time its leaderboard is
+    needed, and only used once it has finished loading. Members who have
+    left the server aren't ranked.
+    """
+
+    def __init__(self, database: Database):
+        self.database = database
+        self.database.register(statements)
+        self.guilds = {}
+
+        # guild_id -> the task loading it, for every caller to wait on
+        self.loading = {}
+        # guild_id -> {member_id: (experience, level), or None if removed} while it loads
+        self.changes = {}
+
+    async def get(self, guild: Guild):
+        ranks = self.guilds.get(guild.id)
+        if ranks is not None:
+            return ranks
+
+        loading = self.loading.get(guild.id)
+        if loading is None:
+            # Changes made while the guild loads are newer than what's read, so they're applied on top
+            changes = self.changes[guild.id] = {}
+            loading = self.loading[guild.id] = asyncio.create_task(
+                self.load(guild, changes))
+        # One caller giving up shouldn't cancel the load for the others
+        return await asyncio.shield(loading)
+
+    async def load(self, guild: Guild, changes: dict):
+        try:
+            rows = await self.database.fetchall("ranks.guild", (guild.id,)) or []
+
+            ranks = GuildRanks()
+            for member_id, experience, level in rows:
+                if guild.get_member(member_id):
+                    ranks.update(member_id, experience, level)
+            for member_id, change in changes.items():
+                if change is None:
+                    ranks.remove(member_id)
+                else:
+                    ranks.update(member_id, *change)
+
+            # Unless the guild was discarded while it loaded
+            if self.changes.get(guild.id) is changes:
+                self.guilds[guild.id] = ranks
+            return ranks
+        finally:
+            if self.changes.get(guild.id) is changes:
+                del self.changes[guild.id]
+            self.loading.pop(guild.id, None)
+
+    def update(self, guild_id: int, member_id: int, experience: int, level: int):
+        ranks = self.guilds.get(guild_id)
+        if ranks is not None:
+            ranks.update(member_id, experience, level)
+        elif guild_id in self.changes:
+            self.changes[guild_id][member_id] = (experience, level)
+
+    def remove(self, guild_id: int, member_id: int):
+        ranks = self.guilds.get(guild_id)
+        if ranks is not None:
+            ranks.remove(member_id)
+        elif guild_id in self.changes:
+            self.changes[guild_id][member_id] = None
+
+    def discard_guild(self, guild_id: int):
+        self.guilds.pop(guild_id, None)
+        self.changes.pop(guild_id, None)
+
+    def clear(self):
+        self.guilds.clear()
+        self.changes.clear()
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from collections import namedtuple
+
+from tools.database import Database
+
+logger = logging.getLogger("kosmo")
+
+# Columns cached for each feature's settings table
+tables = {
+    "CountingSettings": ("enabled", "channel_id", "allow_math"),
+    "LevelingSettings": ("enabled", "multiplier", "stack_roles", "blacklisted_role_id", "announce", "level_up_message"),
+    "StarboardSettings": ("enabled", "channel_id", "required_stars"),
+    "TempVCSettings": ("enabled", "channel_id"),
+    "HaikuSettings": ("enabled", "channel_id", "announce", "react")
+}
+
+rows = {table: namedtuple(table, columns) for table, columns in tables.items()}
+
+# Postgres folds unquoted table names to lowercase, which is what TG_TABLE_NAME sends
+table_names = {table.lower(): table for table in tables}
+
+
+class SettingsCache():
+    """In-process snapshot of every guild's feature settings
+
+    The snapshot is loaded in bulk, then kept up to date by the settings
+    triggers, which NOTIFY on the `settings_updates` channel whenever a row is
+    inserted, updated or deleted.
+    """
+
+    def __init__(self, database: Database):
+        self.database = database
+
+        self.cache = {table: {} for table in tables}
+        # Channel IDs of each table's enabled rows, for handlers that only care about one channel
+        self.channels = {table: set() for table in tables if "channel_id" in tables[table]}
+        self.loaded = False
+        self.listener = None
+
+        # Other tables' caches that want to hear about their changes, see subscribe()
+        self.subscribers = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def statement(self, table: str, where: str = ""):
+        return f"SELECT guild_id, {', '.join(tables[table])} FROM {table} {where};"
+
+    def subscribe(self, table: str, callback):
+        """Call `callback(guild_id)` whenever a guild's rows in `table` change
+
+        `guild_id` is None when changes may have been missed and everything
+        should be reloaded.
+        """
+        self.subscribers.setdefault(table.lower(), []).append(callback)
+
+    async def load(self):
+        """Load every table's settings in bulk and start listening for changes"""
+        if not self.listener or self.listener.done():
+            # The listener loads the snapshot as soon as it is listening
+            self.listener = asyncio.create_task(self.listen())
+        else:
+            await self.load_all()
+
+    async def load_all(self):
+        async with self.database.transaction() as tx:
+            results = {table: await tx.execute(self.statement(table)) for table in tables}
+
+        for table, result in results.items():
+            self.cache[table] = {
+                r[0]: rows[table](*r[1:]) for r in result.fetchall() or []}
+            if table in self.channels:
+                self.channels[table] = {
+                    s.channel_id for s in self.cache[table].values() if s.enabled and s.channel_id}
+
+        self.loaded = True
+
+        for callbacks in self.subscribers.values():
+            for callback in callbacks:
+                callback(None)
+
+        logger.info(f"Loaded {self.entries} guild settings into the cache")
+
+    async def refresh(self, table: str, guild_id: int):
+        """Reload one guild's settings for a table"""
+        settings = await self.database.fetchone(
+            self.statement(table, "WHERE guild_id = %s"), (guild_id,))
+
+        old = self.cache[table].get(guild_id)
+        if settings:
+            new = self.cache[table][guild_id] = rows[table](*settings[1:])
+        else:
+            new = None
+            self.cache[table].pop(guild_id, None)
+
+        if table in self.channels:
+            if old:
+                self.channels[table].discard(old.channel_id)
+            if new and new.enabled and new.channel_id:
+                self.channels[table].add(new.channel_id)
+
+    async def listen(self):
+        while True:
+            try:
+                async for payload in self.database.listen("settings_updates", self.load_all):
+                    name, guild_id = payload.split(" ")
+                    if name in table_names:
+                        await self.refresh(table_names[name], int(guild_id))
+                    for callback in self.subscribers.get(name, []):
+                        callback(int(guild_id))
+            except asyncio.CancelledError:
+                raise
+            except:
+                # Changes can be missed while we aren't listening, so fall back
+                # to the database until the snapshot has been reloaded
+                self.loaded = False
+                logger.error(
+                    "Lost the settings_updates listener, retrying in 5 seconds", exc_info=True)
+                await asyncio.sleep(5)
+
+    async def get(self, table: str, guild_id: int):
+        """Get a guild's settings for a table, or None if it has none"""
+        if self.loaded:
+            self.hits += 1
+            return self.cache[table].get(guild_id)
+
+        self.misses += 1
+        settings = await self.database.fetchone(
+            self.statement(table, "WHERE guild_id = %s"), (guild_id,))
+        return rows[table](*settings[1:]) if settings else None
+
+    def peek(self, table: str, guild_id: int):
+        """A guild's settings for a table from the snapshot, without falling back to the database"""
+        return self.cache[table].get(guild_id)
+
+    def watching(self, table: str, channel_id: int):
+        """Whether a channel might be an enabled channel of a table, without any database call"""
+        if not self.loaded:
+            # Can't rule it out until the snapshot is loaded
+            return True
+        return channel_id in self.channels[table]
+
+    @property
+    def entries(self):
+        return sum(len(c) for c in self.cache.values())
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "entries": self.entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate
+        }
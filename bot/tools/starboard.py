@@ -0,0 +1,129 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
+
+class StarCounter():
+    """Star counts of recently starred messages, kept up to date by raw reaction events
+
+    A message is seeded from one fetch the first time it's starred, along with
+    the ID of its starboard post (if it has one). After that, stars are
+    counted locally. The least recently starred messages are forgotten once
+    there are more than `max_size`, and are seeded again if they're starred later.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        # source_message_id -> [stars, starboard_message_id]
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, message_id: int):
+        """A message's [stars, starboard_message_id], or None if it needs to be seeded"""
+        entry = self.entries.get(message_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(message_id)
+        return entry
+
+    def seed(self, message_id: int, stars: int, post_id: int = None):
+        entry = self.entries[message_id] = [stars, post_id]
+        self.entries.move_to_end(message_id)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def star(self, message_id: int, change: int):
+        """Add `change` stars to a message and return its entry, or None if it needs to be seeded"""
+        entry = self.get(message_id)
+        if entry is not None:
+            entry[0] = max(entry[0] + change, 0)
+        return entry
+
+    def discard(self, message_id: int):
+        self.entries.pop(message_id, None)
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class RequestBudget():
+    """Spaces out requests shared between several tasks to at most `rate` a second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next = 0.0
+
+    async def spend(self):
+        now = monotonic()
+        wait = self.next - now
+        self.next = max(now, self.next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class RenderCache():
+    """Rendered starboard posts, keyed by (source_message_id, edited_at)
+
+    Raw edit events drop a message's render once it's out of date, so the
+    latest render can be reused without fetching the message to check.
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        # source_message_id -> (edited_at, render)
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message_id: int, edited_at=None):
+        entry = self.entries.get(message_id)
+        if entry is None or entry[0] != edited_at:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(message_id)
+        return entry[1]
+
+    def latest(self, message_id: int):
+        """A message's render, if it hasn't been edited since"""
+        entry = self.entries.get(message_id)
+        return self.get(message_id, entry[0] if entry else None)
+
+    def put(self, message_id: int, edited_at, render):
+        self.entries[message_id] = (edited_at, render)
+        self.entries.move_to_end(message_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return render
+
+    def edited(self, message_id: int, edited_at=None):
+        """Drop a message's render unless it's already at `edited_at`"""
+        entry = self.entries.get(message_id)
+        if entry is not None and (edited_at is None or entry[0] != edited_at):
+            del self.entries[message_id]
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
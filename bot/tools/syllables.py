@@ -0,0 +1,92 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+HEADER = struct.Struct("=4sI")
+MAGIC = b"SYL1"
+
+
+def build_index(path: str):
+    """Write the syllable count of every word in the CMU Pronouncing Dictionary to `path`
+
+    The file is a header, then N + 1 word offsets (uint32), then N syllable
+    counts (uint8), then the words themselves, sorted and concatenated.
+    """
+    # Only needed to build the index, and slow to import
+    import cmudict
+
+    # Only a word's first pronunciation is counted
+    words = sorted(
+        (word.encode(), min(sum(p[-1].isdigit() for p in pronunciations[0]), 255))
+        for word, pronunciations in cmudict.dict().items() if pronunciations)
+
+    offsets = array("I", [0])
+    counts = array("B")
+    blob = bytearray()
+    for word, count in words:
+        blob += word
+        offsets.append(len(blob))
+        counts.append(count)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.tmp", "wb") as index:
+        index.write(HEADER.pack(MAGIC, len(words)))
+        index.write(offsets.tobytes())
+        index.write(counts.tobytes())
+        index.write(blob)
+    os.replace(f"{path}.tmp", path)
+
+
+class SyllableIndex():
+    """Read-only word -> syllable count lookups from a memory-mapped index
+
+    Nothing is loaded into Python objects, the pages are shared between
+    processes and only read in as words are looked up. The index is built
+    from cmudict the first time it's needed, or ahead of time with
+    `python -m tools.syllables`.
+    """
+
+    def __init__(self, path: str = "./assets/syllables.idx"):
+        if not os.path.exists(path):
+            build_index(path)
+
+        with open(path, "rb") as index:
+            self.map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.size = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} isn't a syllable index")
+
+        view = memoryview(self.map)
+        start = HEADER.size
+        self.offsets = view[start:start + 4 * (self.size + 1)].cast("I")
+        start += 4 * (self.size + 1)
+        self.counts = view[start:start + self.size]
+        self.words = start + self.size
+
+    def __len__(self):
+        return self.size
+
+    def get(self, word: str):
+        """A word's syllable count, or None if it isn't in the dictionary"""
+        key = word.encode()
+        offsets = self.offsets
+        words = self.words
+
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            found = self.map[words + offsets[middle]:words + offsets[middle + 1]]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return self.counts[middle]
+        return None
+
+
+if __name__ == "__main__":
+    build_index(sys.argv[1] if len(sys.argv) > 1 else "./assets/syllables.idx")
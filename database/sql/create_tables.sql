@@ -94,6 +94,18 @@ CREATE TABLE StarboardMessages (
     CONSTRAINT valid_starboard_message_id CHECK (starboard_message_id >= 0),
     FOREIGN KEY (guild_id) REFERENCES StarboardSettings (guild_id) ON DELETE CASCADE ON UPDATE CASCADE
 );
+-- Creation of Starboard Backfill table, so a history scan can pick up where it left off
+CREATE TABLE StarboardBackfill (
+    guild_id BIGINT NOT NULL,
+    channel_id BIGINT PRIMARY KEY,
+    before_message_id BIGINT,
+    scanned INT NOT NULL DEFAULT 0,
+    done BOOLEAN NOT NULL DEFAULT false,
+    CONSTRAINT valid_guild_id CHECK (guild_id >= 0),
+    CONSTRAINT valid_channel_id CHECK (channel_id >= 0),
+    CONSTRAINT valid_before_message_id CHECK (before_message_id >= 0),
+    FOREIGN KEY (guild_id) REFERENCES StarboardSettings (guild_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
 -- Creation of TempVC Settings table
 CREATE TABLE TempVCSettings (
     guild_id BIGINT PRIMARY KEY,
@@ -201,8 +213,20 @@ CREATE TABLE Reminders(
     expires TIMESTAMPTZ NOT NULL,
     CONSTRAINT valid_user_id CHECK (user_id >= 0)
 );
--- Store the time that settings are updaated
-CREATE FUNCTION handle_settings_updates() RETURNS TRIGGER AS $$ BEGIN NEW.modified_at = NOW();
+-- Store the time that settings are updaated, and tell the bot to refresh its settings cache
+CREATE FUNCTION handle_settings_updates() RETURNS TRIGGER AS $$ BEGIN IF (TG_OP = 'DELETE') THEN PERFORM pg_notify('settings_updates', TG_TABLE_NAME || ' ' || OLD.guild_id);
+RETURN OLD;
+END IF;
+NEW.modified_at = NOW();
+PERFORM pg_notify('settings_updates', TG_TABLE_NAME || ' ' || NEW.guild_id);
+RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+-- Tell the bot to refresh its cache of a table that has no modified_at column
+CREATE FUNCTION notify_settings_updates() RETURNS TRIGGER AS $$ BEGIN IF (TG_OP = 'DELETE') THEN PERFORM pg_notify('settings_updates', TG_TABLE_NAME || ' ' || OLD.guild_id);
+RETURN OLD;
+END IF;
+PERFORM pg_notify('settings_updates', TG_TABLE_NAME || ' ' || NEW.guild_id);
 RETURN NEW;
 END;
 $$ LANGUAGE 'plpgsql';
@@ -246,6 +270,33 @@ UPDATE ON HaikuSettings FOR EACH ROW
         OLD.* IS DISTINCT
         FROM NEW.*
     ) EXECUTE PROCEDURE handle_settings_updates();
+-- Notify the bot when Counting settings are added or removed
+CREATE TRIGGER notify_counting_settings_changes BEFORE
+INSERT
+    OR DELETE ON CountingSettings FOR EACH ROW EXECUTE PROCEDURE handle_settings_updates();
+-- Notify the bot when Leveling settings are added or removed
+CREATE TRIGGER notify_leveling_settings_changes BEFORE
+INSERT
+    OR DELETE ON LevelingSettings FOR EACH ROW EXECUTE PROCEDURE handle_settings_updates();
+-- Notify the bot when Starboard settings are added or removed
+CREATE TRIGGER notify_starboard_settings_changes BEFORE
+INSERT
+    OR DELETE ON StarboardSettings FOR EACH ROW EXECUTE PROCEDURE handle_settings_updates();
+-- Notify the bot when TempVC settings are added or removed
+CREATE TRIGGER notify_tempvc_settings_changes BEFORE
+INSERT
+    OR DELETE ON TempVCSettings FOR EACH ROW EXECUTE PROCEDURE handle_settings_updates();
+-- Notify the bot when Haiku settings are added or removed
+CREATE TRIGGER notify_haiku_settings_changes BEFORE
+INSERT
+    OR DELETE ON HaikuSettings FOR EACH ROW EXECUTE PROCEDURE handle_settings_updates();
+-- Notify the bot when Leveling reward roles change
+CREATE TRIGGER notify_leveling_roles_changes
+AFTER
+INSERT
+    OR
+UPDATE
+    OR DELETE ON LevelingRoles FOR EACH ROW EXECUTE PROCEDURE notify_settings_updates();
 -- Store XP-gain cooldowns
 CREATE TRIGGER update_xp_gain_ts BEFORE
 UPDATE ON MemberExperience FOR EACH ROW